@@ -11,13 +11,23 @@ print(f"FIND CLUSTERS - VERSION {VERSION}")
 
 # pylint: disable=too-complex,pointless-string-statement,multiple-statements,wrong-import-position,no-else-return,unnecessary-pass,useless-suppression,global-statement,use-dict-literal,duplicate-code
 
+import io
 import os
+import gzip
+import shutil
+import hashlib
+import tempfile
 import argparse
 import logging
 import time
+import zipfile
+from contextlib import contextmanager, nullcontext
 from datetime import date
 from itertools import chain
 import subprocess
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 import bte
 import numpy as np
@@ -28,19 +38,40 @@ np.set_printoptions(linewidth=np.inf, threshold=15)
 UINT8_MAX = np.iinfo(np.uint8).max   # UNSIGNED!
 UINT16_MAX = np.iinfo(np.uint16).max # UNSIGNED!
 UINT32_MAX = np.iinfo(np.uint32).max # UNSIGNED!
-MATRIX_INTEGER_MAX = UINT32_MAX      # can be changed by args
+POWERS_OF_TEN = 10 ** np.arange(20, dtype=np.uint64) # every power of ten that fits in a uint64, see format_tsv_rows()
+MATRIX_INTEGER_MAX = UINT32_MAX      # can be changed by args; only used to warn when a matrix needs a bigger dtype than -i8/-i16 asked for
+MATRIX_ENGINE = 'rows'               # can be changed by args; only affects 000000 ('neighbors' means 000000 has no matrix)
+CONDENSED_MATRICES = False           # can be changed by args; if True, Cluster.matrix only stores the upper triangle as a 1D array
+MEMMAP_DIR = None                    # can be changed by args; if set, 000000's matrix is an np.memmap in this directory
+ROW_BLOCK_BYTES = 64 * 1024 * 1024   # roughly how much RAM a block of int64 distances should take when working row-by-row
+MATRIX_COMPRESSION = None            # can be changed by args; 'gzip' or 'zstd' compresses 000000's _dmtrx.tsv as it's written
+MATRIX_FORMAT = 'tsv'                # can be changed by args; 'npy' or 'both' writes each matrix as _dmtrx.npy + _dmtrx.samples.txt
+NEIGHBOR_TSV = False                 # can be changed by args; if True, writes each sample's closest and furthest samples in 000000
+TABLE_FORMAT = 'tsv'                 # can be changed by args; 'parquet' or 'both' writes latest_samples, latest_clusters, and nearest_relatives as Parquet
+NEAREST_RELATIVES = 1                # can be changed by args; how many closest samples (plus ties) nearest_relatives lists for each sample
+NEAREST_RELATIVES_OF_ALL = False     # can be changed by args; if True, nearest_relatives covers every sample rather than just unclustered ones
+PREVIOUS_STATE = None                # can be changed by args; last run's clustering_state.npz, to only calculate what's changed since then
+SAVE_STATE = False                   # can be changed by args; if True, writes clustering_state.npz for the next run's PREVIOUS_STATE
+SINGLE_LINKAGE = False               # can be changed by args; if True, every level of clusters is cut from one minimum spanning forest
+CLUSTER_DISTANCES = (20, 10, 5)      # can be changed by args; --distance then each --recursive-distance (process_clusters.py still expects 20, 10, and 5)
+WORKERS = 1                          # can be changed by args; if >1, 000000's matrix and each 20-cluster's recursion use a process pool
 CURRENT_UUID = np.int32(-1)          # SIGNED!!!!!!!!!!!
 TODAY = date.today().isoformat()
 OUTFILE_PREFIX, TYPE_PREFIX = '', ''                               # Set by parsed args
-INITIAL_PB_PATH, INITIAL_PB_BTE, INITIAL_SAMPS = None, None, None  # Set by parsed args
-BIG_DISTANCE_MATRIX = None     # Distance matrix of 000000
+INITIAL_PB_PATH, INITIAL_SAMPS = None, None  # Set by parsed args
+TREE_INDEX = None              # TreeIndex() of INITIAL_PB_PATH, set by initial_setup()
+INITIAL_PB_BTE = None          # bte.MATree of INITIAL_PB_PATH, set by initial_setup() unless TREE_INDEX came from --tree-cache
+SAMPLES = None                 # SampleRegistry() of INITIAL_SAMPS, set by initial_setup()
+FORK_PARENT_CLUSTER = None     # Cluster() whose subclusters are being built by forked workers, see Cluster.get_clusters_in_workers()
+MATRIX_SHARED_MEMORY = None    # SharedMemory that 000000's matrix lives in while worker processes fill it, see new_matrix()
+LINKAGE = None                 # SingleLinkage() that 000000 builds if SINGLE_LINKAGE, which every cluster cuts its subclusters out of
 ALL_CLUSTERS = []              # List of all Cluster() objects, including 000000
 SAMPLES_IN_ANY_CLUSTER = set() # Set of samples in any cluster, excluding 000000
 UNCLUSTERED_SAMPLES = set()    # Set of samples that are not in any cluster excluding 000000
-SAMPLE_CLUSTER = ['Sample\tCluster\n']   # Nextstrain-style TSV for annotation
-CLUSTER_SAMPLES = ['Cluster\tSamples\n'] # matUtils extract-style TSV for subtrees
-LATEST_CLUSTERS = ['latest_cluster_id\tcurrent_date\tcluster_distance\tmatrix_max\tn_samples\tminimum_tree_size\tsample_ids\n'] # Used by persistent ID script, excludes unclustered
-LATEST_SAMPLES = ['sample_id\tcluster_distance\tlatest_cluster_id\n']                                               # Used by persistent ID script, excludes unclustered
+LATEST_CLUSTERS = []           # (str_UUID, cluster_distance, matrix_max, sample_ids) per cluster, excludes 000000; see latest_clusters_columns()
+LATEST_SAMPLES = []            # (str_UUID, cluster_distance, sample_ids) per cluster, excludes 000000; see latest_samples_columns()
+SUBTREES_TO_EXTRACT = []       # (str_UUID, sample_ids) of every cluster whose subtree extract_subtrees() should write
+ARTIFACTS = None               # ArtifactContainer() that every cluster except 000000 writes its outputs into, if set by args
 
 logging.basicConfig(
     format='[%(asctime)s] %(levelname)s %(message)s',
@@ -48,110 +79,652 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S')
 
 class UnionFind:
-    def __init__(self):
-        self.parent = dict()
+    # Over the ints 0 to n-1 (ie matrix indices). Iterative, with union by rank, so a long chain of samples can't hit the recursion limit.
+    # parent and rank are plain lists rather than numpy arrays because we only ever touch them one element at a time.
+    def __init__(self, n):
+        self.parent = list(range(n))
+        self.rank = [0] * n
 
     def find(self, item):
-        # path compression
-        if self.parent.setdefault(item, item) != item:
-            self.parent[item] = self.find(self.parent[item])
-        return self.parent[item]
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root: # path compression
+            self.parent[item], item = root, self.parent[item]
+        return root
 
     def union(self, a, b):
-        self.parent[self.find(a)] = self.find(b)
+        # Returns False if a and b were already in the same set
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return False
+        if self.rank[root_a] < self.rank[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        if self.rank[root_a] == self.rank[root_b]:
+            self.rank[root_a] += 1
+        return True
+
+    def components(self, items):
+        # Sets containing any of items, as sorted arrays of items, in order of each set's smallest item
+        items = np.unique(items)
+        return [items[group] for group in groups_in_order([self.find(item) for item in items.tolist()])]
+
+class TreeIndex():
+    # Integer-indexed copy of a MAT's topology, built once per run so distances don't need per-pair bte calls.
+    # Nodes are numbered in preorder (root is 0). depth[] is the root-to-node sum of branch lengths, so for any
+    # two nodes, distance(a, b) = depth[a] + depth[b] - 2*depth[LCA(a, b)]. The LCA itself comes from a range
+    # minimum query over an Euler tour of the tree, answered in O(1) with a sparse table.
+    #
+    # Everything is a flat numpy array (children are CSR-style: node i's are child_nodes[child_offsets[i]:child_offsets[i+1]]),
+    # so the whole index can be cached as .npy files and memory-mapped by later runs, see for_pb(). The sparse table is about
+    # log2(n) times bigger than everything else put together, so only the Euler tour it's built from gets cached.
+    CACHED_ARRAYS = ('node_ids', 'name_order', 'parent', 'depth', 'level', 'subtree_end', 'child_offsets', 'child_nodes', 'first')
+
+    def __init__(self, node_ids: list, parent: np.ndarray, depth: np.ndarray):
+        # All three are per node, in preorder (so parents always come before their children); the root's parent is -1
+        start_time = time.time()
+        self.node_ids = np.array(node_ids, dtype=str)
+        self.name_order = np.argsort(self.node_ids, kind='stable') # for looking up nodes by name, see nodes_of()
+        self.parent = parent.astype(np.int32)
+        self.depth = depth.astype(np.int64)  # branch lengths are mutation counts, so ints are fine
+        level = [0] * len(node_ids)          # number of edges from root, used for the RMQ
+        children = [[] for _ in node_ids]
+        for i, p in enumerate(self.parent.tolist()):
+            if p >= 0:
+                level[i] = level[p] + 1
+                children[p].append(i)
+        self.level = np.array(level, dtype=np.int32)
+        self.child_offsets = np.zeros(len(node_ids) + 1, dtype=np.int64)
+        self.child_offsets[1:] = np.cumsum([len(kids) for kids in children])
+        self.child_nodes = np.array(list(chain.from_iterable(children)), dtype=np.int32)
+        self.subtree_end = np.arange(1, len(node_ids) + 1, dtype=np.int64) # node i's descendants are exactly nodes i+1 to subtree_end[i]-1
+        for i in range(len(node_ids) - 1, 0, -1):
+            self.subtree_end[self.parent[i]] = max(self.subtree_end[self.parent[i]], self.subtree_end[i])
+        self.build_euler_tour(children)
+        logging.info("Indexed tree with %s nodes in %.2f sec", len(node_ids), time.time() - start_time)
+
+    @classmethod
+    def from_tree(cls, tree: bte.MATree):
+        nodes = tree.depth_first_expansion() # preorder
+        node_index = {node.id: i for i, node in enumerate(nodes)}
+        parent = np.full(len(nodes), -1, dtype=np.int32)
+        depth = np.zeros(len(nodes), dtype=np.int64)
+        for i, node in enumerate(nodes):
+            if node.parent is not None:
+                parent[i] = node_index[node.parent.id]
+                depth[i] = depth[parent[i]] + int(node.branch_length)
+        return cls([node.id for node in nodes], parent, depth)
+
+    @classmethod
+    def for_pb(cls, pb_path, cache_dir=None):
+        # Parsing a big MAT with bte takes a while, so if we're given a cache_dir (which has to outlive this run to be of any
+        # use), the finished index gets cached in a subdirectory of it named after the .pb's hash. If that's already there, we
+        # memory-map it instead of touching the .pb at all. Returns the index and the bte.MATree we parsed (None if we didn't).
+        if cache_dir is None:
+            tree = bte.MATree(pb_path)
+            return cls.from_tree(tree), tree
+        index_dir = os.path.join(cache_dir, file_hash(pb_path))
+        if os.path.isdir(index_dir):
+            start_time = time.time()
+            tree_index = cls.__new__(cls)
+            for name in cls.CACHED_ARRAYS:
+                setattr(tree_index, name, np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r'))
+            tree_index.build_sparse_table(np.load(os.path.join(index_dir, "euler.npy")))
+            logging.info("Memory-mapped tree index with %s nodes from %s in %.2f sec", len(tree_index.node_ids), index_dir, time.time() - start_time)
+            return tree_index, None
+        tree = bte.MATree(pb_path)
+        tree_index = cls.from_tree(tree)
+        tree_index.write_cache(index_dir)
+        return tree_index, tree
+
+    def write_cache(self, index_dir):
+        # Written into a temporary directory that only gets renamed into place once it's complete, so a run that dies halfway
+        # through (or one running alongside us) never sees a partial cache. Not being able to write it at all is fine.
+        temp_dir = f"{index_dir}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(temp_dir)
+            for name in self.CACHED_ARRAYS:
+                np.save(os.path.join(temp_dir, f"{name}.npy"), getattr(self, name))
+            np.save(os.path.join(temp_dir, "euler.npy"), self.sparse[0])
+            os.rename(temp_dir, index_dir)
+            logging.info("Cached tree index to %s", index_dir)
+        except OSError as e:
+            logging.warning("Couldn't cache tree index to %s (%s), so the next run will have to parse the tree again", index_dir, e)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def to_arrays(self):
+        # Everything needed to rebuild this index with from_arrays(), eg as part of an .npz
+        return {'tree_node_ids': np.asarray(self.node_ids), 'tree_parent': np.asarray(self.parent), 'tree_depth': np.asarray(self.depth)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['tree_node_ids'].tolist(), arrays['tree_parent'], arrays['tree_depth'])
+
+    def build_euler_tour(self, children):
+        # Iterative so we don't hit Python's recursion limit on deep trees. A tour of n nodes is always 2n-1 long (every node
+        # but the root is entered once from its parent, and its parent is revisited once when we're done with it).
+        euler = np.empty(2 * len(children) - 1, dtype=np.int32)
+        euler[0], position = 0, 1
+        self.first = np.zeros(len(children), dtype=np.int64) # first position of each node in the Euler tour
+        next_child = [0] * len(children)
+        stack = [0]
+        while stack:
+            v = stack[-1]
+            if next_child[v] < len(children[v]):
+                c = children[v][next_child[v]]
+                next_child[v] += 1
+                self.first[c] = position
+                euler[position] = c
+                position += 1
+                stack.append(c)
+            else:
+                stack.pop()
+                if stack:
+                    euler[position] = stack[-1]
+                    position += 1
+        self.build_sparse_table(euler)
+
+    def build_sparse_table(self, euler):
+        # sparse[k][i] is whichever node has the lowest level in euler[i:i+2**k]
+        n_log = max(1, int(np.log2(len(euler))) + 1)
+        self.sparse = np.zeros((n_log, len(euler)), dtype=np.int32)
+        self.sparse[0] = euler
+        for k in range(1, n_log):
+            half, width = 1 << (k - 1), len(euler) - (1 << k) + 1
+            left, right = self.sparse[k-1][:width], self.sparse[k-1][half:half+width]
+            self.sparse[k][:width] = np.where(self.level[left] <= self.level[right], left, right)
+        self.log2 = np.zeros(len(euler) + 1, dtype=np.int32)
+        self.log2[2:] = np.floor(np.log2(np.arange(2, len(euler) + 1))).astype(np.int32)
+
+    def sample_ranges(self, sample_nodes):
+        # Because nodes are numbered in preorder, the samples under any node are a contiguous run once sorted by node index.
+        # Returns that sort order, plus where each node's run starts and ends in it.
+        by_node = np.argsort(sample_nodes)
+        sorted_nodes = sample_nodes[by_node]
+        starts = np.searchsorted(sorted_nodes, np.arange(len(self.node_ids)))
+        ends = np.searchsorted(sorted_nodes, self.subtree_end)
+        return by_node, sorted_nodes, starts, ends
+
+    def close_pairs(self, sample_nodes, cutoff):
+        # Every pair of samples within cutoff of each other, as indices into sample_nodes, without calculating any other distance.
+        # Walks the tree like Cluster.fill_matrix_by_blocks() does, but prunes any child subtree whose shallowest sample is already
+        # more than cutoff below the current node, so the work scales with the number of close pairs rather than with n^2.
+        by_node, sorted_nodes, starts, ends = self.sample_ranges(sample_nodes)
+        sorted_depths = self.depth[sorted_nodes]
+        no_samples = np.iinfo(np.int64).max // 4
+        min_depth = self.shallowest_sample_depths(sorted_nodes, sorted_depths, no_samples)
+        pairs_i, pairs_j, pairs_d = [], [], []
+        for node in np.flatnonzero(ends - starts > 1):
+            reach = cutoff + 2 * self.depth[node] # a pair with this LCA is close iff depth_i + depth_j <= reach
+            if 2 * min_depth[node] > reach:
+                continue
+            earlier_min = sorted_depths[starts[node]] if sorted_nodes[starts[node]] == node else no_samples
+            for child in self.children_of(node):
+                child_min = min_depth[child]
+                if starts[child] == ends[child] or child_min - self.depth[node] > cutoff:
+                    continue
+                if child_min + earlier_min <= reach:
+                    rows, cols, distances = self.close_block(sorted_depths,
+                        np.arange(starts[child], ends[child]), np.arange(starts[node], starts[child]), self.depth[node], cutoff)
+                    pairs_i.append(by_node[rows])
+                    pairs_j.append(by_node[cols])
+                    pairs_d.append(distances)
+                earlier_min = min(earlier_min, child_min)
+        if not pairs_i:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        pairs_i, pairs_j, pairs_d = np.concatenate(pairs_i), np.concatenate(pairs_j), np.concatenate(pairs_d)
+        pairs_i, pairs_j = np.minimum(pairs_i, pairs_j), np.maximum(pairs_i, pairs_j)
+        in_matrix_order = np.lexsort((pairs_j, pairs_i))
+        return pairs_i[in_matrix_order], pairs_j[in_matrix_order], pairs_d[in_matrix_order]
+
+    def shallowest_sample_depths(self, sorted_nodes, sorted_depths, no_samples):
+        # Depth of the shallowest sample at or below each node (no_samples if there aren't any), filled in one level at a time
+        min_depth = np.full(len(self.node_ids), no_samples, dtype=np.int64)
+        min_depth[sorted_nodes] = sorted_depths
+        deepest_first = np.argsort(-self.level, kind='stable')
+        for same_level in np.split(deepest_first, np.flatnonzero(np.diff(self.level[deepest_first])) + 1):
+            if self.level[same_level[0]] > 0:
+                np.minimum.at(min_depth, self.parent[same_level], min_depth[same_level])
+        return min_depth
+
+    @staticmethod
+    def close_block(sorted_depths, rows, cols, lca_depth, cutoff):
+        # Every pair within cutoff between rows and cols, two runs of (sorted) samples whose LCA is at lca_depth. Samples too
+        # deep to be close to even the shallowest sample on the other side never make it into the block.
+        reach = cutoff + 2 * lca_depth # a pair with this LCA is close iff depth_i + depth_j <= reach
+        row_min, col_min = sorted_depths[rows].min(), sorted_depths[cols].min()
+        rows, cols = rows[sorted_depths[rows] <= reach - col_min], cols[sorted_depths[cols] <= reach - row_min]
+        block = sorted_depths[rows][:, None] + sorted_depths[cols][None, :] - 2 * lca_depth
+        r, c = np.nonzero(block <= cutoff)
+        return rows[r], cols[c], block[r, c]
+
+    def max_distance_bound(self, nodes):
+        # No two of these nodes can be further apart than the two deepest of them measured from their MRCA. Since nodes are
+        # numbered in preorder, the MRCA of all of them is just the LCA of the first and last one.
+        if len(nodes) < 2:
+            return 0
+        two_deepest = np.partition(self.depth[nodes], len(nodes) - 2)[-2:]
+        return int(two_deepest.sum() - 2 * self.depth[self.lca(nodes.min(), nodes.max())])
+
+    def close_pairs_with(self, sample_nodes, focus, cutoff):
+        # Every pair within cutoff that includes at least one of sample_nodes[focus] (pairs of two focus samples show up twice).
+        # Anything within cutoff of a sample has an LCA with it that's no more than cutoff above it, so we only need to look
+        # at the samples under the highest such ancestor, and then only the ones that aren't too deep to be close.
+        by_node, sorted_nodes, _, _ = self.sample_ranges(sample_nodes)
+        sorted_depths = self.depth[sorted_nodes]
+        pairs_i, pairs_j, pairs_d = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+        for f in focus.tolist():
+            node = top = sample_nodes[f]
+            while self.parent[top] >= 0 and self.depth[node] - self.depth[self.parent[top]] <= cutoff:
+                top = self.parent[top]
+            rows = np.arange(np.searchsorted(sorted_nodes, top), np.searchsorted(sorted_nodes, self.subtree_end[top]))
+            rows = rows[sorted_depths[rows] <= self.depth[node] + cutoff]
+            distances = self.distances(node, sorted_nodes[rows])
+            close = (distances <= cutoff) & (by_node[rows] != f)
+            pairs_i.append(np.full(np.count_nonzero(close), f, dtype=np.int64))
+            pairs_j.append(by_node[rows[close]])
+            pairs_d.append(distances[close])
+        return np.concatenate(pairs_i), np.concatenate(pairs_j), np.concatenate(pairs_d)
+
+    def nearest(self, sample_nodes, focus_nodes, k):
+        # The k samples closest to each of focus_nodes (plus any tied with the kth) out of sample_nodes, without calculating
+        # any other distance. Climbs from each focus sample one ancestor at a time, only looking at the samples that ancestor
+        # adds to what's already been seen, and stops as soon as the next ancestor is further away than the kth closest so far.
+        # Returns (nodes, distances) for each focus node, closest first, with ties in name order.
+        _, sorted_nodes, starts, ends = self.sample_ranges(sample_nodes)
+        sorted_depths = self.depth[sorted_nodes]
+        name_rank = np.empty(len(self.node_ids), dtype=np.int64)
+        name_rank[self.name_order] = np.arange(len(self.node_ids))
+        results = []
+        for leaf in focus_nodes.tolist():
+            found_rows, found_distances, kth = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)], np.iinfo(np.int64).max
+            seen = leaf # the samples under seen have all been looked at (which, to start with, is just the focus sample itself)
+            while self.parent[seen] >= 0 and self.depth[leaf] - self.depth[self.parent[seen]] <= kth:
+                ancestor = self.parent[seen]
+                rows = np.r_[starts[ancestor]:starts[seen], ends[seen]:ends[ancestor]]
+                distances = sorted_depths[rows] + self.depth[leaf] - 2 * self.depth[ancestor]
+                close_enough = distances <= kth
+                found_rows.append(rows[close_enough])
+                found_distances.append(distances[close_enough])
+                if sum(len(d) for d in found_distances) >= k:
+                    found_rows, found_distances = [np.concatenate(found_rows)], [np.concatenate(found_distances)]
+                    kth = np.partition(found_distances[0], k - 1)[k - 1]
+                seen = ancestor
+            rows, distances = np.concatenate(found_rows), np.concatenate(found_distances)
+            rows, distances = rows[distances <= kth], distances[distances <= kth]
+            closest_first = np.lexsort((name_rank[sorted_nodes[rows]], distances))
+            results.append((sorted_nodes[rows[closest_first]], distances[closest_first]))
+        return results
+
+    def children_of(self, node):
+        return self.child_nodes[self.child_offsets[node]:self.child_offsets[node+1]].tolist()
+
+    def leaves(self):
+        # Names of every node without children, ie every sample on the tree
+        return self.node_ids[self.child_offsets[:-1] == self.child_offsets[1:]].tolist()
+
+    def nodes_of(self, samples):
+        # Binary search over the names in sorted order rather than a dict, so a memory-mapped index doesn't need to build one
+        samples = np.array(samples, dtype=str)
+        found = self.name_order[np.minimum(np.searchsorted(self.node_ids, samples, sorter=self.name_order), len(self.node_ids) - 1)]
+        missing = self.node_ids[found] != samples
+        if missing.any():
+            raise KeyError(f"{samples[missing][0]} isn't on the tree")
+        return found.astype(np.int64)
+
+    def lca(self, a, b):
+        # a and b are node indices (or broadcastable arrays of them)
+        first_a, first_b = self.first[a], self.first[b]
+        lo, hi = np.minimum(first_a, first_b), np.maximum(first_a, first_b)
+        k = self.log2[hi - lo + 1]
+        left, right = self.sparse[k, lo], self.sparse[k, hi - (1 << k) + 1]
+        return np.where(self.level[left] <= self.level[right], left, right)
+
+    def distances(self, a, b):
+        # Returns int64 distances, so the caller is responsible for fitting them into a matrix's dtype
+        return self.depth[a] + self.depth[b] - 2 * self.depth[self.lca(a, b)]
+
+    def newick(self, nodes):
+        # Newick of the subtree induced by these nodes, same as what matUtils extract -s then -t gives us: the only internal nodes
+        # left are ones that are an LCA of two of them (or are one of them), so chains of unary nodes collapse into one branch
+        # whose length is their sum. Every such LCA is the LCA of two nodes that are consecutive in preorder.
+        nodes = np.unique(nodes)
+        kept = np.unique(np.concatenate([nodes, self.lca(nodes[:-1], nodes[1:])])).tolist()
+        induced_parent, open_nodes = [-1] * len(kept), []
+        for k, node in enumerate(kept):
+            while open_nodes and self.subtree_end[kept[open_nodes[-1]]] <= node:
+                open_nodes.pop()
+            induced_parent[k] = open_nodes[-1] if open_nodes else -1
+            open_nodes.append(k)
+        has_children = [False] * len(kept)
+        for p in induced_parent:
+            if p >= 0:
+                has_children[p] = True
+
+        def label(k):
+            if induced_parent[k] < 0:
+                return str(self.node_ids[kept[k]])
+            return f"{self.node_ids[kept[k]]}:{self.depth[kept[k]] - self.depth[kept[induced_parent[k]]]}"
+
+        out, open_nodes = [], []
+        for k in range(len(kept)):
+            while open_nodes and induced_parent[k] != open_nodes[-1]:
+                out.append(")" + label(open_nodes.pop()))
+            if open_nodes and out[-1] != "(":
+                out.append(",")
+            if has_children[k]:
+                out.append("(")
+                open_nodes.append(k)
+            else:
+                out.append(label(k))
+        while open_nodes:
+            out.append(")" + label(open_nodes.pop()))
+        return "".join(out) + ";"
+
+class SingleLinkage():
+    # Our clusters are single-linkage, so every level of them can be read off of one minimum spanning forest of the pairs within
+    # the biggest cluster distance: clusters at distance d are whatever stays connected after cutting every edge longer than d.
+    # That's one sort plus one pass over the pairs, after which each level (or any extra one) only costs a pass over n-1 edges.
+    def __init__(self, sample_ids, pairs_i, pairs_j, pairs_d):
+        # sample_ids are SAMPLES indices (sorted), and pairs_i/pairs_j are positions in sample_ids
+        start_time = time.time()
+        self.sample_ids = sample_ids
+        uf, forest = UnionFind(len(sample_ids)), []
+        by_distance = np.argsort(pairs_d, kind='stable')
+        for k, i, j in zip(by_distance.tolist(), pairs_i[by_distance].tolist(), pairs_j[by_distance].tolist()): # Kruskal's
+            if uf.union(i, j):
+                forest.append(k)
+        self.edges_i, self.edges_j, self.edges_d = pairs_i[forest], pairs_j[forest], pairs_d[forest]
+        self.labels = {}
+        logging.info("Built single-linkage forest with %s edges from %s pairs in %.2f sec", len(forest), len(pairs_d), time.time() - start_time)
+
+    def labels_at(self, distance):
+        # Component label of every sample after cutting edges longer than distance; samples in the same cluster share a label
+        if distance not in self.labels:
+            uf = UnionFind(len(self.sample_ids))
+            for a, b in zip(self.edges_i[self.edges_d <= distance].tolist(), self.edges_j[self.edges_d <= distance].tolist()):
+                uf.union(a, b)
+            self.labels[distance] = np.array([uf.find(i) for i in range(len(self.sample_ids))], dtype=np.int64)
+        return self.labels[distance]
+
+    def clusters_within(self, sample_ids, distance):
+        # Clusters at distance among sample_ids (which must be sorted and be a whole cluster at some bigger distance), as arrays
+        # of sample IDs, in order of each cluster's first sample -- the same order UnionFind-ing the neighbors would give us.
+        # Also returns the samples that aren't in any of those clusters.
+        groups = groups_in_order(self.labels_at(distance)[np.searchsorted(self.sample_ids, sample_ids)])
+        clusters = [sample_ids[group] for group in groups if len(group) > 1]
+        loners = [sample_ids[group[0]] for group in groups if len(group) == 1]
+        return clusters, loners
+
+class SampleRegistry():
+    # Every sample in this run, numbered in sorted order, so sorting sample IDs also sorts them by name. Clusters only carry
+    # arrays of these IDs, which don't get turned back into names until something needs to be written out.
+    def __init__(self, samples: list, tree_index: TreeIndex):
+        assert len(samples) == len(set(samples))
+        self.names = np.array(sorted(samples), dtype=object)
+        self.index = {name: i for i, name in enumerate(self.names.tolist())} # hashed, so membership checks are O(1)
+        self.nodes = tree_index.nodes_of(self.names) # each sample's node in tree_index
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def ids_of(self, names):
+        return np.sort(np.array([self.index[name] for name in names], dtype=np.int32))
+
+    def names_of(self, sample_ids):
+        return self.names[sample_ids].tolist()
+
+class ArtifactContainer():
+    # One uncompressed zip that clusters write their outputs into, instead of a separate file (or three) per output. Every member
+    # has the same name the file would have had, so it's keyed by cluster UUID and type, and the zip's central directory is an
+    # index that process_clusters.py can read any one of them from without extracting anything. Only the process that opened
+    # the zip can write to it, so a forked worker holds on to what it writes until cluster_family_worker() sends it back.
+    # The zip is only open (and so only writable) inside a with block.
+    def __init__(self, path):
+        self.path = path
+        self.zipfile = None
+        self.names = set()
+        self.owner = os.getpid()
+        self.held = [] # (name, bytes) written by a forked worker, see take_held()
+
+    def __enter__(self):
+        self.zipfile = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_STORED, allowZip64=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.zipfile.close()
+        logging.info("Wrote %s outputs to %s", len(self.names), self.path)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    @contextmanager
+    def open(self, name):
+        # Binary file object whose contents become the member called name once it's closed
+        assert name not in self.names, f"Tried to write {name} to {self.path} but it's already in there?!"
+        self.names.add(name)
+        if os.getpid() == self.owner:
+            with self.zipfile.open(name, "w", force_zip64=True) as member:
+                yield member
+        else:
+            buffer = io.BytesIO()
+            yield buffer
+            self.held.append((name, buffer.getvalue()))
+
+    def add(self, name, data: bytes):
+        with self.open(name) as member:
+            member.write(data)
+
+    def add_file(self, name, path):
+        with open(path, "rb") as infile, self.open(name) as member:
+            shutil.copyfileobj(infile, member, 16 * 1024 * 1024)
+
+    def take_held(self):
+        held, self.held = self.held, []
+        return held
 
 class Cluster():
-    def __init__(self, UUID: int, samples: list, distance: np.uint32, input_pb: bte.MATree, *, subcluster: bool, track_unclustered: bool, writetree: bool, writemax: bool):
+    # Once a cluster's matrix is written and its subclusters exist, drop_matrix() clears everything but the first row of slots below, so
+    # ALL_CLUSTERS only ever holds compact records and peak memory is one chain of matrices (000000 -> 20 -> 10 -> 5) at a time.
+    __slots__ = ('str_UUID', 'cluster_distance', 'sample_ids', 'matrix_max', 'subclusters', 'get_subclusters', 'track_unclustered', 'fs_ops',
+        'matrix', 'matrix_from_parent', 'extremes')
+
+    def __init__(self, UUID: int, sample_ids: np.ndarray, distance: np.uint32, *, subcluster: bool, track_unclustered: bool, writetree: bool, writemax: bool, parent=None):
         self.str_UUID = self.set_str_UUID(UUID)
-        assert len(samples) == len(set(samples))
-        self.samples = sorted(samples)
-        self.get_subclusters = False if distance == 5 else subcluster
+        self.fs_ops = 0 # filesystem calls made to write this cluster's outputs, logged by log_fs_ops()
+        self.sample_ids = np.asarray(sample_ids, dtype=np.int32) # SAMPLES IDs, which are also this cluster's matrix rows/columns in order
+        assert np.all(self.sample_ids[1:] > self.sample_ids[:-1]), "sample IDs must be sorted and unique"
+        self.get_subclusters = False if next_cluster_distance(distance) is None else subcluster
         self.track_unclustered = track_unclustered
         if distance > UINT32_MAX:
             raise ValueError("🔚distance is a value greater than the unsigned-uint32 maximum used when generating matrices; cannot continue")
         self.cluster_distance = np.uint32(distance)
-        logging.info("[%s] Hello, I have %s samples: %s", self.debug_name(), len(self.samples), self.samples)
+        logging.info("[%s] Hello, I have %s samples: %s", self.debug_name(), len(self.sample_ids), self.samples)
         self.update_most_globals()
         
         # initalize other stuff
         self.subclusters = []
-        self.unclustered = set()
-        self.input_pb = input_pb
-
-        # Currently using a 32-bit unsigned int matrix in hopes of less aggressive RAM usage
-        if MATRIX_INTEGER_MAX == UINT8_MAX:
-            self.matrix = np.full((len(samples),len(samples)), 0, dtype=np.uint8)  # UNSIGNED!
-        elif MATRIX_INTEGER_MAX == UINT16_MAX:
-            self.matrix = np.full((len(samples),len(samples)), 0, dtype=np.uint16) # UNSIGNED!
+
+        # Every pair of samples in a subcluster was already calculated by its parent cluster, so if the parent has a matrix,
+        # we just take our rows/columns out of it instead of going back to the tree
+        self.matrix_from_parent = parent is not None and parent.matrix is not None
+
+        # Each matrix gets the smallest unsigned int dtype that can hold every distance it could possibly contain
+        self.extremes = None # (closest, furthest) distance of each sample to any other sample, see distance_extremes()
+        if self.matrix_from_parent:
+            parent_rows = np.searchsorted(parent.sample_ids, self.sample_ids).astype(np.int64)
+            if CONDENSED_MATRICES:
+                upper_i, upper_j = np.triu_indices(len(self.sample_ids), 1)
+                self.matrix = parent.matrix[condensed_index(len(parent.sample_ids), parent_rows[upper_i], parent_rows[upper_j])]
+            else:
+                self.matrix = parent.matrix[np.ix_(parent_rows, parent_rows)]
+            # We know exactly how big our distances are, which is usually a lot smaller than our parent's biggest
+            self.matrix = self.matrix.astype(matrix_dtype(self.matrix.max(initial=0), self.debug_name()), copy=False)
+        elif self.cluster_distance == UINT32_MAX and MATRIX_ENGINE == 'neighbors':
+            self.matrix = None # we'll never need the whole-tree matrix, so don't even allocate it
         else:
-            self.matrix = np.full((len(samples),len(samples)), 0, dtype=np.uint32) # UNSIGNED!
-
-        # Updates self.matrix, self.subclusters, and self.unclustered
-        if self.cluster_distance == UINT32_MAX:
-            self.subclusters = self.dist_matrix_and_get_subclusters(self.input_pb, 20) # None if not get_subclusters
-        elif self.cluster_distance == 20:
-            self.subclusters = self.dist_matrix_and_get_subclusters(self.input_pb, 10) # None if not get_subclusters
-        elif self.cluster_distance == 10:
-            self.subclusters = self.dist_matrix_and_get_subclusters(self.input_pb, 5) # None if not get_subclusters
+            self.matrix = new_matrix(self, matrix_dtype(TREE_INDEX.max_distance_bound(SAMPLES.nodes[self.sample_ids]), self.debug_name()))
+
+        # Updates self.matrix and self.subclusters, and marks unclustered samples
+        subcluster_distance = next_cluster_distance(self.cluster_distance)
+        if subcluster_distance is not None:
+            self.subclusters = self.dist_matrix_and_get_subclusters(TREE_INDEX, subcluster_distance) # None if not get_subclusters
         else:
-            # we already forced self.get_subclusters to false if distance is 5; all we're doing here is setting self.matrix
-            self.dist_matrix_and_get_subclusters(self.input_pb, 5)
+            # we already forced self.get_subclusters to false at the smallest distance; all we're doing here is setting self.matrix
+            self.dist_matrix_and_get_subclusters(TREE_INDEX, CLUSTER_DISTANCES[-1])
 
         # This represents the actual maximum distance in this cluster, which might be more or less than self.cluster_distance.
         # If the matrix_max is 0 (ie if the matrix is full of zeroes) then there is a bug in Microreact that prevents the
         # tree from displaying properly, so having this value will be helpful later.
         if self.cluster_distance != UINT32_MAX:
-            self.matrix_max = max(max(l) for l in self.matrix)
+            _, furthest = self.distance_extremes()
+            self.matrix_max = self.matrix.dtype.type(max(0, furthest.max(initial=0)))
             self.update_latest_clusters()
         else:
             # probably unnecessary
             self.matrix_max = -1        
         
         if self.get_subclusters:
-            logging.info("[%s] Processed %s samples, found %s subclusters", self.debug_name(), len(self.samples), len(self.subclusters))
+            logging.info("[%s] Processed %s samples, found %s subclusters", self.debug_name(), len(self.sample_ids), len(self.subclusters))
         else:
-            logging.debug("[%s] Processed %s samples (not subclustering further)", self.debug_name(), len(self.samples))     
+            logging.debug("[%s] Processed %s samples (not subclustering further)", self.debug_name(), len(self.sample_ids))     
+
+        if NEIGHBOR_TSV and self.cluster_distance == UINT32_MAX and self.matrix is not None:
+            find_neighbors(self, f"{TYPE_PREFIX}{OUTFILE_PREFIX}{self.str_UUID}_neighbors.tsv", plus_unclustered_focus=True)
 
         # write distance matrix (and subtree in two formats)
-        self.write_dmatrix()
-        if writetree:
-            self.write_subtrees()
+        write_dmatrix(self)
+        drop_matrix(self)
         if writemax:
-            self.write_matrix_max()
+            write_matrix_max(self)
+        if writetree:
+            SUBTREES_TO_EXTRACT.append((self.str_UUID, self.sample_ids)) # extract_subtrees() will call log_fs_ops() after that
+        else:
+            self.log_fs_ops()
+
+    def set_upper_row(self, i, j_start, values):
+        # matrix[i][j] and matrix[j][i] for every j >= j_start, where j_start > i
+        if CONDENSED_MATRICES:
+            row_start = condensed_index(len(self.sample_ids), i, j_start)
+            self.matrix[row_start:row_start + len(values)] = values
+        else:
+            self.matrix[i, j_start:], self.matrix[j_start:, i] = values, values
+
+    def set_block(self, rows, cols, block):
+        # matrix[rows[x]][cols[y]] and matrix[cols[y]][rows[x]] = block[x][y], where no sample is in both rows and cols
+        block = block.astype(self.matrix.dtype, copy=False)
+        if CONDENSED_MATRICES:
+            i, j = rows[:, None], cols[None, :]
+            self.matrix[condensed_index(len(self.sample_ids), np.minimum(i, j), np.maximum(i, j))] = block
+        else:
+            self.matrix[np.ix_(rows, cols)] = block
+            self.matrix[np.ix_(cols, rows)] = block.T
+
+    def matrix_rows(self, start, stop):
+        # Rows start to stop-1 of the square matrix, even if the matrix is actually condensed
+        if not CONDENSED_MATRICES:
+            return self.matrix[start:stop]
+        n = len(self.sample_ids)
+        i, j = np.arange(start, min(stop, n), dtype=np.int64)[:, None], np.arange(n, dtype=np.int64)[None, :]
+        off_diagonal = np.broadcast_to(i != j, (len(i), n))
+        rows = np.zeros((len(i), n), dtype=self.matrix.dtype)
+        rows[off_diagonal] = self.matrix[condensed_index(n, np.minimum(i, j), np.maximum(i, j))[off_diagonal]]
+        return rows
+
+    def distance_extremes(self, with_samples=False):
+        # One pass over the finished matrix (a block of rows at a time) for each sample's closest and furthest distance to any
+        # other sample, without changing the matrix. If with_samples, also returns which samples are at those distances, as
+        # arrays of matrix indices. The distances are cached since every cluster needs them at least once.
+        if self.extremes is not None and not with_samples:
+            return self.extremes
+        n = len(self.sample_ids)
+        closest, furthest = np.full(n, np.iinfo(np.int64).max, dtype=np.int64), np.full(n, -1, dtype=np.int64)
+        closest_samples, furthest_samples = [], []
+        chunk_rows = rows_per_block(n)
+        for chunk_start in range(0, n, chunk_rows):
+            rows = self.matrix_rows(chunk_start, chunk_start + chunk_rows).astype(np.int64)
+            chunk = slice(chunk_start, chunk_start + rows.shape[0])
+            diagonal = np.arange(rows.shape[0]), np.arange(rows.shape[0]) + chunk_start
+            rows[diagonal] = -1 # self-self can't be furthest...
+            furthest[chunk] = rows.max(axis=1, initial=-1)
+            if with_samples:
+                furthest_samples.extend(indices_by_row(rows == furthest[chunk][:, None], rows.shape[0]))
+            rows[diagonal] = np.iinfo(np.int64).max # ...or closest
+            closest[chunk] = rows.min(axis=1, initial=np.iinfo(np.int64).max)
+            if with_samples:
+                closest_samples.extend(indices_by_row(rows == closest[chunk][:, None], rows.shape[0]))
+        self.extremes = closest, furthest
+        if with_samples:
+            return closest, furthest, closest_samples, furthest_samples
+        return closest, furthest
+
+    @property
+    def samples(self):
+        # Sample names, for outputs -- everything else should use self.sample_ids
+        return SAMPLES.names_of(self.sample_ids)
 
     def set_str_UUID(self, int_UUID):
         return str(int_UUID).zfill(6)
 
     def update_most_globals(self):
-        # Doesn't set BIG_DISTANCE_MATRIX since we call this function before calling the distance matrix function (and we do that to get
-        # some semblance of order, lest the 5SNP clusters end up here first, which would probably be fine I think but a bit weird)
+        # We call this function before calling the distance matrix function to get some semblance of order, lest the 5SNP
+        # clusters end up here first, which would probably be fine I think but a bit weird
         if self.cluster_distance != UINT32_MAX:
             ALL_CLUSTERS.append(self)
-            SAMPLES_IN_ANY_CLUSTER.add(sample for sample in self.samples)
-            CLUSTER_SAMPLES.append(f"{self.str_UUID}\t{','.join(self.samples)}\n")     # ⬇️ actual max      ⬇️ n_samples        ⬇️ minimum_tree_size 
-            #LATEST_CLUSTERS.append(f"{self.str_UUID}\t{TODAY}\t{self.cluster_distance}\t{self.matrix_max}\t{len(self.samples)}\t{len(self.samples)}\t{self.samples}\n")
-            for s in self.samples:
-                SAMPLE_CLUSTER.append(f"{s}\t{self.str_UUID}\n")
-                LATEST_SAMPLES.append(f"{s}\t{self.cluster_distance}\t{self.str_UUID}\n")
+            SAMPLES_IN_ANY_CLUSTER.update(self.sample_ids.tolist())
+            LATEST_SAMPLES.append((self.str_UUID, int(self.cluster_distance), self.sample_ids))
 
     def update_latest_clusters(self):
         # We have to call this one after calculating the distance matrix since it now includes matrix_max
         if self.cluster_distance != UINT32_MAX:
-            LATEST_CLUSTERS.append(f"{self.str_UUID}\t{TODAY}\t{self.cluster_distance}\t{self.matrix_max}\t{len(self.samples)}\t{len(self.samples)}\t{self.samples}\n")
+            LATEST_CLUSTERS.append((self.str_UUID, int(self.cluster_distance), int(self.matrix_max), self.sample_ids))
 
     def debug_name(self):
         return f"{self.str_UUID}@{str(self.cluster_distance).zfill(2)}"
 
-    def dist_matrix_and_get_subclusters(self, tree_to_matrix: bte.MATree, subcluster_distance):
-        # Updates self.matrix, self.subclusters, and self.unclustered
-        i_samples = self.samples  # this was sorted() earlier so it should be sorted in matrix
+    def dist_matrix_and_get_subclusters(self, tree_index: TreeIndex, subcluster_distance):
+        # Updates self.matrix and self.subclusters, and marks unclustered samples
+        i_samples = self.sample_ids  # these are sorted, so they're in the same order as the matrix
         j_ghost_index = 0
-        neighbors = []
+        sample_nodes = SAMPLES.nodes[self.sample_ids]
+        neighbors_i, neighbors_j = [no_neighbors()[0]], [no_neighbors()[1]]
         matrix_start_time = time.time()
 
-        for i, this_samp in enumerate(i_samples):
-            definitely_in_a_cluster = False
+        if SINGLE_LINKAGE and self.get_subclusters:
+            return self.subclusters_from_linkage(tree_index, sample_nodes, subcluster_distance)
+
+        if self.matrix_from_parent:
+            neighbors = self.scan_matrix_for_neighbors(subcluster_distance)
+            logging.info("[%s] Took matrix from parent cluster and checked it for neighbors in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+            return self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
+
+        if self.cluster_distance == UINT32_MAX and MATRIX_ENGINE == 'neighbors':
+            neighbors = self.neighbors_from_tree(tree_index, sample_nodes, subcluster_distance)
+            logging.info("[%s] Finished searching for neighbors (without a matrix) in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+            return self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
+
+        if WORKERS > 1 and self.cluster_distance == UINT32_MAX and MATRIX_ENGINE == 'rows':
+            neighbors = self.fill_matrix_in_workers(sample_nodes, subcluster_distance)
+            logging.info("[%s] Finished calculating matrix with %s workers in %.2f sec", self.debug_name(), WORKERS, time.time() - matrix_start_time)
+            return self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
+
+        if isinstance(self.matrix, np.memmap) and MATRIX_ENGINE == 'rows':
+            self.fill_matrix_by_row_blocks(tree_index, sample_nodes)
+            neighbors = self.scan_matrix_for_neighbors(subcluster_distance)
+            logging.info("[%s] Finished calculating memory-mapped matrix in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+            return self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
 
+        if self.cluster_distance == UINT32_MAX and MATRIX_ENGINE == 'blocks':
+            self.fill_matrix_by_blocks(tree_index, sample_nodes)
+            neighbors = self.scan_matrix_for_neighbors(subcluster_distance)
+            logging.info("[%s] Finished calculating matrix samples in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+            return self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
+
+        for i, this_samp in enumerate(SAMPLES.names[i_samples]):
             # The pool of samples we allow for j shrinks by one with every iteration of i,
             # in order to prevent calculating distances twice. (We can do this only because
             # our matrix is square and we're starting with two equivalent sorted lists.)
@@ -183,88 +756,175 @@ class Cluster():
             # in order to place these calculated values in the correct place on the matrix.
             # j_ghost_index + enumerate(j_samples) = correct index for the j bit of the matrix
             j_ghost_index += 1
-            j_samples = self.samples[j_ghost_index:]
-
-            for j, that_samp in enumerate(j_samples):
-
-                j_matrix = j + j_ghost_index
-                logging.debug("j %s, j_ghost_index %s, j_matrix %s, that_samp %s", j, j_ghost_index, j_matrix, that_samp)
-
-                this_node, that_node = this_samp, that_samp
-                LCA = tree_to_matrix.LCA([this_samp, that_samp])     # type str
-                logging.debug("%s:%s LCA is %s", this_samp, that_samp, LCA)
-                total_distance = self.sum_paths_to_LCA_plus_overflow_check(tree_to_matrix, this_node, that_node, LCA)
-                self.matrix[i][j_matrix], self.matrix[j_matrix][i] = total_distance, total_distance
-                if self.get_subclusters and total_distance <= subcluster_distance:
-                    logging.debug("  %s and %s seem to be within a %sSNP-cluster (%s)", this_samp, that_samp, subcluster_distance, total_distance)
-                    neighbors.append(tuple((this_samp, that_samp)))
-                    definitely_in_a_cluster = True
-
-            # Consider samples A, B, C, D, and E. When i = A, j=B, so we calculate their distance, then assign the result to matrix[A][B]
-            # and matrix[B][A]. Then j=C, so we get the distance, assign matrix[A][C] and matrix[C][A], etc...
-            # Because the j array is shrinking per iteration of i, that can prevent definitely_in_a_cluster from being triggered if it
-            # ought to, which is why we need this bit below.
-            if self.get_subclusters and not definitely_in_a_cluster:
-                second_smallest_distance = np.partition(self.matrix[i], 1)[1] # second smallest, because smallest is self-self at 0
-                if second_smallest_distance <= subcluster_distance:
-                    #logging.debug("  Oops, %s was already clustered! (closest sample is %s SNPs away)", this_samp, second_smallest_distance)
-                    pass
-                else:
-                    #logging.debug("  %s appears to be truly unclustered (closest sample is %s SNPs away)", this_samp, second_smallest_distance)
-                    if subcluster_distance in (UINT32_MAX, 20): # pylint: disable=else-if-used  # only add to global unclustered if it's not in a 20 SNP cluster
-                        if this_samp in INITIAL_SAMPS:
-                            UNCLUSTERED_SAMPLES.add(this_samp) # attempt to fix https://github.com/aofarrel/tree_nine/issues/41
+            if j_ghost_index < len(i_samples):
+                # All of i's distances to j_samples are calculated at once from the tree index
+                total_distances = self.fit_to_matrix_dtype(tree_index.distances(sample_nodes[i], sample_nodes[j_ghost_index:]), this_samp)
+                self.set_upper_row(i, j_ghost_index, total_distances)
+                if self.get_subclusters:
+                    close = np.flatnonzero(total_distances <= subcluster_distance)
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        for j in close:
+                            logging.debug("  %s and %s seem to be within a %sSNP-cluster (%s)", this_samp, SAMPLES.names[i_samples[j + j_ghost_index]], subcluster_distance, total_distances[j])
+                    neighbors_i.append(np.full(len(close), i, dtype=np.int32))
+                    neighbors_j.append((close + j_ghost_index).astype(np.int32))
+
+        # Consider samples A, B, C, D, and E. When i = A, j=B, so we calculate their distance, then assign the result to matrix[A][B]
+        # and matrix[B][A]. Then j=C, so we get the distance, assign matrix[A][C] and matrix[C][A], etc...
+        # Because the j array is shrinking per iteration of i, the neighbors above don't tell us if the closest sample to E is
+        # A, which is why we need to check each sample's closest sample once the matrix is complete.
+        if self.get_subclusters:
+            closest, _ = self.distance_extremes()
+            for i in np.flatnonzero(closest > subcluster_distance):
+                #logging.debug("  %s appears to be truly unclustered (closest sample is %s SNPs away)", SAMPLES.names[i_samples[i]], closest[i])
+                self.mark_unclustered(i_samples[i], subcluster_distance)
 
         # finished iterating, let's see what our clusters look like
         #logging.info("Here is our matrix")
         #logging.info(self.matrix)
-        # This doesn't print len(self.samples) because that was printed earlier already
+        # This doesn't print len(self.sample_ids) because that was printed earlier already
         logging.info("[%s] Finished calculating matrix samples in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+        neighbors = np.concatenate(neighbors_i), np.concatenate(neighbors_j)
         subclusters = self.get_true_clusters(neighbors, self.get_subclusters, subcluster_distance) # None if !get_subclusters
         return subclusters
 
-    def sum_paths_to_LCA_plus_overflow_check(self, tree_to_matrix, this_node, that_node, LCA):
-        this_path, that_path = 0,0
-        while tree_to_matrix.get_node(this_node).id != LCA:
-            this_node = tree_to_matrix.get_node(this_node)   # type MATnode
-            this_path += this_node.branch_length             # type float
-            this_node = this_node.parent.id                  # type str
-        while tree_to_matrix.get_node(that_node).id != LCA:
-            that_node = tree_to_matrix.get_node(that_node)   # type MATnode
-            that_path += that_node.branch_length             # type float
-            that_node = that_node.parent.id                  # type str
-        total_distance_i64 = this_path + that_path
-        if total_distance_i64 > MATRIX_INTEGER_MAX:
-            # this is a debug instead of a warning because it happens so often in the uint8 case
-            logging.debug("Total distance between %s and %s is %s, greater than integer maximum; will store as %s", this_node, that_node, total_distance_i64, MATRIX_INTEGER_MAX)
-            return self.convert_64int_to_whatever(MATRIX_INTEGER_MAX)
-        else:
-            return self.convert_64int_to_whatever(total_distance_i64)
+    def subclusters_from_linkage(self, tree_index: TreeIndex, sample_nodes, subcluster_distance):
+        # Instead of looking for neighbors in every cluster's matrix, 000000 builds one single-linkage forest out of every pair
+        # within CLUSTER_DISTANCES[0] and every cluster (including 000000) just cuts its subclusters out of that
+        global LINKAGE
+        matrix_start_time = time.time()
+        if self.cluster_distance == UINT32_MAX and PREVIOUS_STATE is not None:
+            LINKAGE = incremental_linkage(PREVIOUS_STATE)
+        if self.cluster_distance == UINT32_MAX and LINKAGE is None:
+            LINKAGE = SingleLinkage(self.sample_ids, *tree_index.close_pairs(sample_nodes, max(CLUSTER_DISTANCES)))
+        if not self.matrix_from_parent:
+            # We still want our matrix, but any neighbors found while filling it would be redundant
+            self.get_subclusters = False
+            self.dist_matrix_and_get_subclusters(tree_index, subcluster_distance)
+            self.get_subclusters = True
+        true_clusters, loners = LINKAGE.clusters_within(self.sample_ids, subcluster_distance)
+        for this_samp in loners:
+            self.mark_unclustered(this_samp, subcluster_distance)
+        logging.info("[%s] Finished matrix and single-linkage subclusters in %.2f sec", self.debug_name(), time.time() - matrix_start_time)
+        logging.info("[%s] Looking for subclusters @ %d", self.debug_name(), subcluster_distance)
+        logging.debug("[%s] Got these clusters: %s", self.debug_name(), true_clusters)
+        return self.make_subclusters(true_clusters, subcluster_distance)
+
+    def mark_unclustered(self, sample_id, subcluster_distance):
+        # sample_id is a SAMPLES ID, and SAMPLES is INITIAL_SAMPS, which is the check we need for https://github.com/aofarrel/tree_nine/issues/41
+        if subcluster_distance in {UINT32_MAX, CLUSTER_DISTANCES[0]}: # only add to global unclustered if it's not in a 20 SNP cluster
+            UNCLUSTERED_SAMPLES.add(SAMPLES.names[sample_id])
+
+    def fill_matrix_by_blocks(self, tree_index: TreeIndex, sample_nodes):
+        # Alternative to the row-by-row loop: one post-order pass over the tree, where each internal node writes the distances
+        # between all samples in one of its child subtrees and all samples in its earlier child subtrees as a single block.
+        # Every pair of samples has exactly one LCA, so every cell gets written exactly once (well, twice, counting [j][i]).
+        # Blocks near the root can cover a good fraction of the whole matrix, so they're written a chunk of rows at a time, like
+        # fill_matrix_by_row_blocks(), to keep the int64 distances (and scatter indices) down to one chunk's worth.
+        by_node, sorted_nodes, starts, ends = tree_index.sample_ranges(sample_nodes)
+        sorted_depths = tree_index.depth[sorted_nodes]
+        for node in np.flatnonzero(ends - starts > 1)[::-1]: # reverse preorder == children before parents
+            # If this node is itself a sample, it sorts first, so it just becomes part of the "earlier" columns
+            for child in tree_index.children_of(node):
+                if starts[child] == ends[child] or starts[child] == starts[node]:
+                    continue
+                cols = np.arange(starts[node], starts[child])
+                chunk_rows = rows_per_block(len(cols))
+                for chunk_start in range(starts[child], ends[child], chunk_rows):
+                    rows = np.arange(chunk_start, min(chunk_start + chunk_rows, ends[child]))
+                    block = sorted_depths[rows][:, None] + sorted_depths[cols][None, :] - 2 * tree_index.depth[node]
+                    block = self.fit_to_matrix_dtype(block, f"[samples below {tree_index.node_ids[node]}]")
+                    self.set_block(by_node[rows], by_node[cols], block)
 
-    def convert_64int_to_whatever(self, python_int64):
-        if MATRIX_INTEGER_MAX == UINT8_MAX:
-            return np.uint8(python_int64)      # UNSIGNED!
-        elif MATRIX_INTEGER_MAX == UINT16_MAX:
-            return np.uint16(python_int64)     # UNSIGNED!
+    def fill_matrix_by_row_blocks(self, tree_index: TreeIndex, sample_nodes):
+        # Like the row-by-row loop, but calculates entire rows (not just j > i) a block of rows at a time, so a memory-mapped matrix
+        # gets written front-to-back and we never hold more than one block of int64 distances in RAM.
+        n = len(sample_nodes)
+        block_rows = rows_per_block(n)
+        for start in range(0, n, block_rows):
+            stop = min(start + block_rows, n)
+            if CONDENSED_MATRICES:
+                for i in range(start, min(stop, n - 1)):
+                    self.set_upper_row(i, i + 1, self.fit_to_matrix_dtype(tree_index.distances(sample_nodes[i], sample_nodes[i+1:]), SAMPLES.names[self.sample_ids[i]]))
+            else:
+                block = tree_index.distances(sample_nodes[start:stop, None], sample_nodes[None, :])
+                self.matrix[start:stop] = self.fit_to_matrix_dtype(block, f"[rows {start} to {stop-1}]")
+            if isinstance(self.matrix, np.memmap):
+                self.matrix.flush()
+
+    def neighbors_from_tree(self, tree_index: TreeIndex, sample_nodes, subcluster_distance):
+        # Same neighbors (in the same order) and unclustered samples as scan_matrix_for_neighbors(), but there's no matrix to scan
+        if not self.get_subclusters:
+            return no_neighbors()
+        pairs_i, pairs_j, _ = tree_index.close_pairs(sample_nodes, subcluster_distance)
+        return self.neighbors_from_pairs(pairs_i, pairs_j, subcluster_distance)
+
+    def neighbors_from_pairs(self, pairs_i, pairs_j, subcluster_distance):
+        # pairs_i and pairs_j are matrix indices of every close pair (with i < j, in matrix order); anyone not in a pair is unclustered
+        for i in np.setdiff1d(np.arange(len(self.sample_ids)), np.concatenate((pairs_i, pairs_j))):
+            self.mark_unclustered(self.sample_ids[i], subcluster_distance)
+        return pairs_i.astype(np.int32), pairs_j.astype(np.int32)
+
+    def fill_matrix_in_workers(self, sample_nodes, subcluster_distance):
+        # Splits the upper triangle into row blocks with about the same number of cells each (early rows are longer than late
+        # ones), several per worker. Workers write into the shared matrix and only send back their close pairs, which we merge
+        # in row order so the neighbors come out in exactly the same order as the single-process loop.
+        n = len(sample_nodes)
+        cells_through_row = np.cumsum(np.arange(n - 1, -1, -1, dtype=np.int64))
+        n_blocks = min(n, WORKERS * 4)
+        block_edges = np.unique(np.concatenate(([0], np.searchsorted(cells_through_row, np.linspace(0, cells_through_row[-1], n_blocks + 1)[1:-1]), [n])))
+        if isinstance(self.matrix, np.memmap):
+            self.matrix.flush()
+            target = ('memmap', self.matrix.filename, self.matrix.dtype, self.matrix.shape)
         else:
-            return np.uint32(python_int64)     # UNSIGNED!
+            target = ('shm', MATRIX_SHARED_MEMORY.name, self.matrix.dtype, self.matrix.shape)
+        with ProcessPoolExecutor(max_workers=WORKERS, mp_context=multiprocessing.get_context('fork')) as pool:
+            futures = [pool.submit(fill_upper_rows_worker, target, sample_nodes, row_start, row_stop, subcluster_distance)
+                for row_start, row_stop in zip(block_edges[:-1], block_edges[1:])]
+            results = [future.result() for future in futures]
+        logging.debug("[%s] Split matrix into %s row blocks", self.debug_name(), len(results))
+        if not self.get_subclusters:
+            return no_neighbors()
+        pairs_i = np.concatenate([pairs[0] for pairs in results])
+        pairs_j = np.concatenate([pairs[1] for pairs in results])
+        return self.neighbors_from_pairs(pairs_i, pairs_j, subcluster_distance)
+
+    def scan_matrix_for_neighbors(self, subcluster_distance):
+        # Same neighbors (in the same order) and unclustered samples as the row-by-row loop, but read back out of a finished matrix
+        if not self.get_subclusters:
+            return no_neighbors()
+        neighbors_i, neighbors_j = [no_neighbors()[0]], [no_neighbors()[1]]
+        chunk_rows = rows_per_block(len(self.sample_ids))
+        for chunk_start in range(0, len(self.sample_ids), chunk_rows):
+            close = self.matrix_rows(chunk_start, chunk_start + chunk_rows) <= subcluster_distance
+            chunk_rows_here = np.arange(close.shape[0])
+            close[chunk_rows_here, chunk_rows_here + chunk_start] = False # self-self doesn't count
+            for i in np.flatnonzero(~close.any(axis=1)):
+                self.mark_unclustered(self.sample_ids[i + chunk_start], subcluster_distance)
+            close[np.arange(close.shape[1])[None, :] <= (chunk_rows_here + chunk_start)[:, None]] = False # only j > i
+            close_i, close_j = np.nonzero(close)
+            neighbors_i.append((close_i + chunk_start).astype(np.int32))
+            neighbors_j.append(close_j.astype(np.int32))
+        return np.concatenate(neighbors_i), np.concatenate(neighbors_j)
+
+    def fit_to_matrix_dtype(self, total_distances_i64, this_samp):
+        # The matrix's dtype was picked to hold any distance between its samples, so this should never fail, but it's
+        # better to crash than to quietly write the wrong distances
+        if total_distances_i64.max(initial=0) > np.iinfo(self.matrix.dtype).max:
+            raise ValueError(f"🔚{this_samp} has distances that don't fit in this matrix's dtype ({self.matrix.dtype}); cannot continue")
+        return total_distances_i64.astype(self.matrix.dtype)
 
     def get_true_clusters(self, neighbors, get_subclusters, subcluster_distance):
         # From neighbors we generated while making distance matrix, define (sub)clusters
-        # Every cluster here is is a list of sample IDs
+        # neighbors is two int32 arrays, where self.sample_ids[neighbors[0][k]] and self.sample_ids[neighbors[1][k]] are close
+        # Every cluster here is is an array of sample IDs
         if get_subclusters:
             logging.info("[%s] Looking for subclusters @ %d", self.debug_name(), subcluster_distance)
             #logging.debug("[%s] Got this list of neighbors: %s", self.debug_name(), neighbors)
-            true_clusters, truer_clusters = [], []
 
-            uf = UnionFind()
-            for a, b in neighbors:
+            uf = UnionFind(len(self.sample_ids))
+            for a, b in zip(neighbors[0].tolist(), neighbors[1].tolist()):
                 uf.union(a, b)
-            clusters_dict = defaultdict(set)
-            for sample in uf.parent:
-                root = uf.find(sample)
-                clusters_dict[root].add(sample)
-            true_clusters = list(clusters_dict.values())
+            true_clusters = [self.sample_ids[component] for component in uf.components(np.concatenate(neighbors))]
             logging.debug("[%s] Got these clusters: %s", self.debug_name(), true_clusters)
             
             # Since the big refactor there shouldn't be any overlapping clusters. But, to prevent issues in
@@ -274,71 +934,66 @@ class Cluster():
             if len(all_samples) != len(set(all_samples)): # TODO: make this an assert later
                 logging.warning("[%s] Detected overlapping subclusters", self.debug_name())
                 true_clusters = self.deal_with_subcluster_overlap(true_clusters)
-
-            for cluster in true_clusters:
-                logging.debug("[%s] For cluster %s in true_clusters %s", self.debug_name(), cluster, true_clusters)
-                if subcluster_distance == UINT32_MAX:
-                    truer_clusters.append(Cluster(next_UUID(), list(cluster), UINT32_MAX, self.input_pb, 
-                        subcluster=True, track_unclustered=True, writetree=True, writemax=False))
-                elif subcluster_distance == 20:
-                    truer_clusters.append(Cluster(next_UUID(), list(cluster), 20, self.input_pb, 
-                        subcluster=True, track_unclustered=False, writetree=True, writemax=False))
-                elif subcluster_distance == 10:
-                    truer_clusters.append(Cluster(next_UUID(), list(cluster), 10, self.input_pb, 
-                        subcluster=True, track_unclustered=False, writetree=True, writemax=False))
-                else:
-                    truer_clusters.append(Cluster(next_UUID(), list(cluster), 5, self.input_pb, 
-                        subcluster=False, track_unclustered=False, writetree=True, writemax=False))
-            return truer_clusters
+            return self.make_subclusters(true_clusters, subcluster_distance)
         else:
             return None
 
-    def write_matrix_max(self):
-        max_outfile = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{self.str_UUID}.int"
-        assert not os.path.exists(max_outfile), f"Tried to write maximum of matrix to {max_outfile}.int but it already exists?!"
-        with open(max_outfile, "w", encoding="utf-8") as outfile:
-            outfile.write(str(self.matrix_max))
-
-    def write_subtrees(self):
-        # It would probably more effiecient to extract all subtrees for all clusters at once, rather than one per cluster, but this
-        # is easier to implement and keep track of.
-        # TODO: also extract JSON version of the tree and add metadata to it (-M metadata_tsv) even though that doesn't go to MR
-        tree_outfile = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{self.str_UUID}" # extension breaks if using -N, see https://github.com/yatisht/usher/issues/389
-        assert not os.path.exists(f"{tree_outfile}.nwk"), f"Tried to make subtree called {tree_outfile}.nwk but it already exists?!"
-        with open("temp_extract_these_samps.txt", "w", encoding="utf-8") as temp_extract_these_samps:
-            temp_extract_these_samps.writelines(line + '\n' for line in self.samples)
-        handle_subprocess(f"Extracting {tree_outfile} pb for {self.str_UUID}...",
-            f'matUtils extract -i "{INITIAL_PB_PATH}" -o {tree_outfile}.pb -s temp_extract_these_samps.txt') # DO NOT INCLUDE QUOTES IT BREAKS THINGS
-        handle_subprocess(f"Turning {tree_outfile} pb for {self.str_UUID} into nwk...",
-            f'matUtils extract -i {tree_outfile}.pb -t {tree_outfile}.nwk') # DO NOT INCLUDE QUOTES IT BREAKS THINGS
-        if os.path.exists(f"{tree_outfile}-subtree-1.nw"):
-            logging.warning("Generated multiple subtrees for %s, attempting batch rename (this may break things)", self.str_UUID)
-            [os.rename(f, f[:-2] + "nwk") for f in os.listdir() if f.endswith(".nw")] # pylint: disable=expression-not-assigned
-        else:
-            [os.rename(f, f[:-13] + ".nwk") for f in os.listdir() if f.endswith("-subtree-0.nw")] # pylint: disable=expression-not-assigned
-        if os.path.exists("subtree-assignments.tsv"):
-            os.rename("subtree-assignments.tsv", "lonely-subtree-assignments.tsv")
-
-    def write_dmatrix(self):
-        # Write distance matrix. Also update global distance matrix for entire tree if applicable.
-        matrix_out = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{self.str_UUID}_dmtrx.tsv"
-        assert not os.path.exists(matrix_out), f"Tried to write {matrix_out} but it already exists?!"
-        with open(matrix_out, "a", encoding="utf-8") as outfile:
-            outfile.write('sample\t'+'\t'.join(self.samples))
-            outfile.write("\n")                # enumerate causes some type issues, just stick with range(len()) for now
-            for k in range(len(self.samples)): # pylint: disable=consider-using-enumerate
-                line = [str(int(count)) for count in self.matrix[k]]
-                outfile.write(f'{self.samples[k]}\t' + '\t'.join(line) + '\n')
-        logging.info("[%s] Wrote distance matrix to %s", self.debug_name(), matrix_out)
-        if logging.root.level == logging.DEBUG and os.path.getsize(matrix_out) < 52428800:
-            logging.debug("[%s] It looks like this:", self.debug_name())
-            with open(matrix_out, "r", encoding='utf-8') as f:
-                print(f.read())
-        else:
-            logging.debug("[%s] And we're not printing it because it's huge", self.debug_name())
-        if self.cluster_distance == UINT32_MAX:
-            global BIG_DISTANCE_MATRIX
-            BIG_DISTANCE_MATRIX = self.matrix
+    def make_subclusters(self, true_clusters, subcluster_distance):
+        # Every cluster in true_clusters is a sorted array of sample IDs, which we turn into Cluster() objects
+        truer_clusters = []
+        if WORKERS > 1 and subcluster_distance == CLUSTER_DISTANCES[0] and len(true_clusters) > 1:
+            return self.get_clusters_in_workers(true_clusters)
+
+        for cluster in true_clusters:
+            logging.debug("[%s] For cluster %s in true_clusters %s", self.debug_name(), cluster, true_clusters)
+            if subcluster_distance == UINT32_MAX:
+                truer_clusters.append(Cluster(next_UUID(), cluster, UINT32_MAX,
+                    subcluster=True, track_unclustered=True, writetree=True, writemax=False, parent=self))
+            else:
+                # subcluster=True at the smallest distance just gets forced back to False
+                truer_clusters.append(Cluster(next_UUID(), cluster, subcluster_distance,
+                    subcluster=True, track_unclustered=False, writetree=True, writemax=False, parent=self))
+        return truer_clusters
+
+    def get_clusters_in_workers(self, true_clusters):
+        # Every 20-cluster (and its 10 and 5 subclusters) is independent of every other 20-cluster, so each one's whole family
+        # is built in a forked worker. We can't know how many UUIDs a family needs until it's built, so each one gets a scratch
+        # range up front (a 20-cluster of n samples can't have more than n/2 10-clusters, which in turn can't have more than
+        # n/2 5-clusters between them, so n+1 UUIDs is always enough), placed after every UUID the real numbering could reach.
+        # The globals each family adds to are then merged back, and renumbered, in the same order as if we had built them one
+        # after another, so every cluster ends up with the same UUID as with one worker.
+        global FORK_PARENT_CLUSTER
+        scratch_sizes = [len(cluster) + 1 for cluster in true_clusters]
+        first_scratch_UUIDs = (int(CURRENT_UUID) + 1 + sum(scratch_sizes) + np.cumsum([0] + scratch_sizes[:-1])).tolist()
+        biggest_first = sorted(range(len(true_clusters)), key=lambda k: -len(true_clusters[k])) # so a big one doesn't start last
+        context = multiprocessing.get_context('fork')
+        FORK_PARENT_CLUSTER = self
+        logging.info("[%s] Building %s clusters' families with %s workers", self.debug_name(), len(true_clusters), WORKERS)
+        with ProcessPoolExecutor(max_workers=WORKERS, mp_context=context) as pool:
+            futures = {k: pool.submit(cluster_family_worker, first_scratch_UUIDs[k], true_clusters[k]) for k in biggest_first}
+            results = [futures[k].result() for k in range(len(true_clusters))]
+        FORK_PARENT_CLUSTER = None
+
+        truer_clusters = []
+        for cluster, family, new_lines, new_unclustered, held in results:
+            new_UUIDs = {member.str_UUID: member.set_str_UUID(next_UUID()) for member in family} # family is in UUID order
+            for member in family:
+                renumber_cluster(member, new_UUIDs[member.str_UUID])
+            for name, data in held:
+                ARTIFACTS.add(renumbered_output(name, new_UUIDs), data)
+            for member in family:
+                SAMPLES_IN_ANY_CLUSTER.update(member.sample_ids.tolist())
+            ALL_CLUSTERS.extend(family)
+            for global_list, lines in zip((LATEST_CLUSTERS, LATEST_SAMPLES, SUBTREES_TO_EXTRACT), new_lines):
+                global_list.extend((new_UUIDs[line[0]],) + line[1:] for line in lines)
+            UNCLUSTERED_SAMPLES.update(new_unclustered)
+            truer_clusters.append(cluster)
+        return truer_clusters
+
+    def log_fs_ops(self):
+        # Every output a cluster writes has a name we already know, so this should stay a small constant per cluster; if it
+        # ever starts growing with the number of clusters, something is scanning the workdir again (or not using fs_op())
+        logging.info("[%s] Wrote outputs with %s filesystem operations", self.debug_name(), self.fs_ops)
 
     def deal_with_subcluster_overlap(self, tuples_list):
         logging.debug("[%s] got tuples_list %s of type %s", self.debug_name(), tuples_list, type(tuples_list))
@@ -367,6 +1022,251 @@ class Cluster():
 
 ########## Global Functions ###########
 
+def new_matrix(cluster, dtype):
+    global MATRIX_SHARED_MEMORY
+    shape = (condensed_size(len(cluster.sample_ids)),) if CONDENSED_MATRICES else (len(cluster.sample_ids), len(cluster.sample_ids))
+    if MEMMAP_DIR is not None and cluster.cluster_distance == UINT32_MAX:
+        # Out-of-core: the OS pages this in and out of the file as needed, so RAM doesn't have to hold n^2 distances
+        matrix_file = os.path.join(MEMMAP_DIR, f"{TYPE_PREFIX}{OUTFILE_PREFIX}{cluster.str_UUID}_dmtrx.{np.dtype(dtype).name}.mmap")
+        logging.info("[%s] Memory-mapping matrix to %s", cluster.debug_name(), matrix_file)
+        return fs_op(cluster, np.memmap, matrix_file, dtype=dtype, mode="w+", shape=shape) # starts zeroed
+    if WORKERS > 1 and cluster.cluster_distance == UINT32_MAX and MATRIX_ENGINE == 'rows':
+        # Worker processes write their rows straight into this, so nothing but neighbors has to be pickled back
+        MATRIX_SHARED_MEMORY = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+        matrix = np.ndarray(shape, dtype=dtype, buffer=MATRIX_SHARED_MEMORY.buf)
+        matrix.fill(0)
+        return matrix
+    return np.zeros(shape, dtype=dtype)
+
+def drop_matrix(cluster):
+    # The cluster's matrix has been written and its subclusters (the only other things that needed it) are done, so let it go;
+    # once that's 000000, nothing is left to cut out of LINKAGE either
+    global LINKAGE, MATRIX_SHARED_MEMORY
+    cluster.matrix, cluster.extremes = None, None
+    if cluster.cluster_distance == UINT32_MAX:
+        LINKAGE = None
+    if cluster.cluster_distance == UINT32_MAX and MATRIX_SHARED_MEMORY is not None:
+        # A SharedMemory block can't be closed while anything still points into it, hence doing this after cluster.matrix = None
+        MATRIX_SHARED_MEMORY.close()
+        MATRIX_SHARED_MEMORY.unlink()
+        MATRIX_SHARED_MEMORY = None
+
+def write_matrix_max(cluster):
+    max_outfile = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{cluster.str_UUID}.int"
+    if in_artifacts(cluster):
+        ARTIFACTS.add(max_outfile, str(cluster.matrix_max).encode("utf-8"))
+        return
+    already_exists = fs_op(cluster, os.path.exists, max_outfile)
+    assert not already_exists, f"Tried to write maximum of matrix to {max_outfile}.int but it already exists?!"
+    with fs_op(cluster, open, max_outfile, "w", encoding="utf-8") as outfile:
+        outfile.write(str(cluster.matrix_max))
+
+def in_artifacts(cluster):
+    # 000000's outputs are task-level outputs in their own right, so they always stay separate files
+    return ARTIFACTS is not None and cluster.cluster_distance != UINT32_MAX
+
+def write_dmatrix(cluster):
+    # Write distance matrix
+    matrix_base = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{cluster.str_UUID}_dmtrx"
+    if cluster.matrix is None:
+        logging.info("[%s] Not writing %s since this cluster never had a matrix", cluster.debug_name(), matrix_base)
+        return
+    if MATRIX_FORMAT in {'npy', 'both'}:
+        write_dmatrix_npy(cluster, matrix_base)
+    if MATRIX_FORMAT in {'tsv', 'both'}:
+        write_dmatrix_tsv(cluster, f"{matrix_base}.tsv")
+    if isinstance(cluster.matrix, np.memmap):
+        fs_op(cluster, os.remove, cluster.matrix.filename) # already open, so the mapping itself stays valid
+        logging.debug("[%s] Removed %s now that it's been written out", cluster.debug_name(), cluster.matrix.filename)
+
+def write_dmatrix_npy(cluster, matrix_base):
+    # The same square matrix as the TSV, but memory-mappable with no parsing at all, plus the sample each row/column is for
+    npy_out = f"{matrix_base}.npy"
+    n = len(cluster.sample_ids)
+    if in_artifacts(cluster):
+        # Can't memory-map a zip member, so write the npy header ourselves and stream the same blocks of rows after it
+        with ARTIFACTS.open(npy_out) as member:
+            np.lib.format.write_array_header_1_0(member, {'descr': np.lib.format.dtype_to_descr(cluster.matrix.dtype), 'fortran_order': False, 'shape': (n, n)})
+            step = rows_per_block(n)
+            for start in range(0, n, step):
+                member.write(np.ascontiguousarray(cluster.matrix_rows(start, start + step), dtype=cluster.matrix.dtype).tobytes())
+        ARTIFACTS.add(f"{matrix_base}.samples.txt", ''.join(sample + '\n' for sample in cluster.samples).encode("utf-8"))
+        logging.info("[%s] Wrote distance matrix to %s in %s", cluster.debug_name(), npy_out, ARTIFACTS.path)
+        return
+    already_exists = fs_op(cluster, os.path.exists, npy_out)
+    assert not already_exists, f"Tried to write {npy_out} but it already exists?!"
+    square = fs_op(cluster, np.lib.format.open_memmap, npy_out, mode="w+", dtype=cluster.matrix.dtype, shape=(n, n))
+    step = rows_per_block(n)
+    for start in range(0, n, step):
+        square[start:start+step] = cluster.matrix_rows(start, start + step)
+    square.flush()
+    del square
+    with fs_op(cluster, open, f"{matrix_base}.samples.txt", "w", encoding="utf-8") as samples_out:
+        samples_out.writelines(sample + '\n' for sample in cluster.samples)
+    logging.info("[%s] Wrote distance matrix to %s", cluster.debug_name(), npy_out)
+
+def write_dmatrix_tsv(cluster, matrix_out):
+    # Only the whole-tree matrix gets compressed, since process_clusters.py reads the others as plain TSVs
+    compression = MATRIX_COMPRESSION if cluster.cluster_distance == UINT32_MAX else None
+    matrix_out += COMPRESSED_SUFFIXES[compression]
+    samples = cluster.samples
+    if in_artifacts(cluster):
+        with ARTIFACTS.open(matrix_out) as member:
+            write_tsv_rows(cluster, member, samples)
+        logging.info("[%s] Wrote distance matrix to %s in %s", cluster.debug_name(), matrix_out, ARTIFACTS.path)
+        return
+    already_exists = fs_op(cluster, os.path.exists, matrix_out)
+    assert not already_exists, f"Tried to write {matrix_out} but it already exists?!"
+    with fs_op(cluster, open_for_writing, matrix_out, compression) as outfile:
+        write_tsv_rows(cluster, outfile, samples)
+    logging.info("[%s] Wrote distance matrix to %s", cluster.debug_name(), matrix_out)
+
+def write_tsv_rows(cluster, outfile, samples):
+    outfile.write(('sample\t' + '\t'.join(samples) + '\n').encode("utf-8"))
+    step = rows_per_block(len(samples))
+    for start in range(0, len(samples), step):
+        outfile.write(format_tsv_rows(samples[start:start+step], cluster.matrix_rows(start, start + step)))
+
+def fill_upper_rows_worker(target, sample_nodes, row_start, row_stop, subcluster_distance):
+    # Runs in a worker process forked by Cluster.fill_matrix_in_workers(), so TREE_INDEX and friends are already set.
+    # Fills the upper triangle of rows row_start to row_stop-1 (and their mirror image, if the matrix is square) of a matrix that
+    # lives in shared memory or a memory-mapped file, then returns the close pairs it found in those rows. target is where that
+    # matrix is: ('shm', shared memory name, dtype, shape) or ('memmap', file path, dtype, shape).
+    kind, where, dtype, shape = target
+    shm = shared_memory.SharedMemory(name=where) if kind == 'shm' else None
+    matrix = np.ndarray(shape, dtype=dtype, buffer=shm.buf) if kind == 'shm' else np.memmap(where, dtype=dtype, mode='r+', shape=shape)
+    n = len(sample_nodes)
+    pairs_i, pairs_j = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+    for i in range(row_start, min(row_stop, n - 1)):
+        row = TREE_INDEX.distances(sample_nodes[i], sample_nodes[i+1:]).astype(dtype) # dtype already fits every distance
+        if len(shape) == 1:
+            row_offset = condensed_index(n, i, i + 1)
+            matrix[row_offset:row_offset + len(row)] = row
+        else:
+            matrix[i, i+1:], matrix[i+1:, i] = row, row
+        close = np.flatnonzero(row <= subcluster_distance) + i + 1
+        pairs_i.append(np.full(len(close), i, dtype=np.int64))
+        pairs_j.append(close)
+    if kind == 'memmap':
+        matrix.flush()
+    del matrix
+    if shm is not None:
+        shm.close()
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+def renumber_cluster(cluster, str_UUID):
+    # Gives a cluster that was built in a worker under a scratch UUID its real one, along with any loose files it wrote (which
+    # can only be its matrix, see write_dmatrix(); what it put in ARTIFACTS is renamed by renumbered_output() instead)
+    logging.debug("[%s] Renumbering to %s", cluster.debug_name(), str_UUID)
+    if not in_artifacts(cluster):
+        old_base, new_base = (f"{TYPE_PREFIX}{OUTFILE_PREFIX}{UUID}_dmtrx" for UUID in (cluster.str_UUID, str_UUID))
+        suffixes = (['.npy', '.samples.txt'] if MATRIX_FORMAT in {'npy', 'both'} else []) + (['.tsv'] if MATRIX_FORMAT in {'tsv', 'both'} else [])
+        for suffix in suffixes:
+            fs_op(cluster, os.replace, old_base + suffix, new_base + suffix)
+    cluster.str_UUID = str_UUID
+
+def renumbered_output(name, new_UUIDs):
+    # name is one of the f"{TYPE_PREFIX}{OUTFILE_PREFIX}{str_UUID}..." outputs of a cluster whose UUID is in new_UUIDs
+    prefix = f"{TYPE_PREFIX}{OUTFILE_PREFIX}"
+    rest = name[len(prefix):]
+    old_UUID = rest[:len(rest) - len(rest.lstrip("0123456789"))]
+    return prefix + new_UUIDs[old_UUID] + rest[len(old_UUID):]
+
+def cluster_family_worker(first_UUID, sample_ids):
+    # Runs in a worker process forked by Cluster.get_clusters_in_workers(), so FORK_PARENT_CLUSTER (and its matrix) is already
+    # set. Builds one 20-cluster and all of its subclusters, then sends back everything that would have gone into the globals.
+    global CURRENT_UUID
+    CURRENT_UUID = np.int32(first_UUID - 1)
+    already_had = len(ALL_CLUSTERS), len(LATEST_CLUSTERS), len(LATEST_SAMPLES), len(SUBTREES_TO_EXTRACT)
+    already_unclustered = set(UNCLUSTERED_SAMPLES)
+    cluster = Cluster(next_UUID(), sample_ids, CLUSTER_DISTANCES[0],
+        subcluster=True, track_unclustered=False, writetree=True, writemax=False, parent=FORK_PARENT_CLUSTER)
+    family = ALL_CLUSTERS[already_had[0]:] # all of them have already dropped their matrices, so they're cheap to send back
+    new_lines = tuple(global_list[n:] for global_list, n in zip((LATEST_CLUSTERS, LATEST_SAMPLES, SUBTREES_TO_EXTRACT), already_had[1:]))
+    held = ARTIFACTS.take_held() if ARTIFACTS is not None else [] # every artifact this family wrote, in the order it wrote them
+    return cluster, family, new_lines, UNCLUSTERED_SAMPLES - already_unclustered, held
+
+def no_neighbors():
+    return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+
+def groups_in_order(labels):
+    # Indices of labels grouped by label, in order of each label's first appearance
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    groups = np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])
+    return [groups[label] for label in np.argsort(first)]
+
+def indices_by_row(mask, n_rows):
+    # Column indices of the True values in each row of a 2D boolean array
+    rows, cols = np.nonzero(mask)
+    return np.split(cols, np.cumsum(np.bincount(rows, minlength=n_rows))[:-1])
+
+def matrix_dtype(max_distance, debug_name):
+    # Smallest unsigned int that can hold max_distance; distances are never truncated to fit a smaller one
+    dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64) if max_distance <= np.iinfo(dtype).max)
+    if np.iinfo(dtype).max > MATRIX_INTEGER_MAX:
+        logging.warning("[%s] Distances up to %s need a %s matrix, which is bigger than requested", debug_name, max_distance, np.dtype(dtype).name)
+    logging.debug("[%s] Using %s matrix for distances up to %s", debug_name, np.dtype(dtype).name, max_distance)
+    return dtype
+
+def format_tsv_rows(names, block):
+    # The same bytes as writing f"{name}\t" + "\t".join(str(int(x)) for x in row) + "\n" for every row of block, but without any
+    # per-number Python: we count each number's digits, work out where every name/tab/digit/newline lands, then scatter them
+    # all into one buffer with a handful of numpy operations per digit place (of the biggest number).
+    names = [name.encode("utf-8") for name in names]
+    values = np.asarray(block).astype(np.uint64, copy=False)
+    n_digits = np.maximum(1, np.searchsorted(POWERS_OF_TEN, values, side='right'))
+    name_lengths = np.array([len(name) for name in names], dtype=np.int64)
+    cell_lengths = n_digits + 1 # tab + digits
+    row_lengths = name_lengths + cell_lengths.sum(axis=1) + 1
+    row_starts = np.cumsum(row_lengths) - row_lengths
+    cell_starts = row_starts[:, None] + name_lengths[:, None] + np.cumsum(cell_lengths, axis=1) - cell_lengths
+
+    out = np.empty(int(row_lengths.sum()), dtype=np.uint8)
+    out[np.repeat(row_starts - (np.cumsum(name_lengths) - name_lengths), name_lengths) + np.arange(name_lengths.sum())] = np.frombuffer(b"".join(names), dtype=np.uint8)
+    out[cell_starts] = ord("\t")
+    positions, left = (cell_starts + n_digits).ravel(), values.ravel() # fill in digits from the ones place leftwards
+    while len(positions):
+        out[positions] = ord("0") + left % 10
+        left = left // 10
+        more = left > 0
+        positions, left = positions[more] - 1, left[more]
+    out[row_starts + row_lengths - 1] = ord("\n")
+    return out.tobytes()
+
+COMPRESSED_SUFFIXES = {None: "", 'gzip': ".gz", 'zstd': ".zst"}
+
+def fs_op(cluster, function, *args, **kwargs):
+    # Makes one filesystem call (open(), os.path.exists(), os.remove(), etc) on behalf of cluster's outputs, counting it in
+    # cluster.fs_ops; whatever function returns is returned as-is
+    cluster.fs_ops += 1
+    return function(*args, **kwargs)
+
+def open_for_writing(path, compression):
+    # Binary file object that compresses as it's written if compression is 'gzip' or 'zstd' (path should already have the suffix)
+    if compression == 'gzip':
+        return gzip.open(path, "wb", compresslevel=1) # same as the pigz -1 we use on everything else
+    if compression == 'zstd':
+        import zstandard # pylint: disable=import-outside-toplevel,import-error
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb")) # pylint: disable=consider-using-with
+    return open(path, "wb") # pylint: disable=consider-using-with
+
+def rows_per_block(n_columns):
+    return max(1, ROW_BLOCK_BYTES // (8 * max(1, n_columns)))
+
+def condensed_size(n):
+    return n * (n - 1) // 2
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def condensed_index(n, i, j):
+    # Position of square matrix [i][j] in a condensed (upper triangle, row-major, no diagonal) matrix; requires i < j
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
 def initial_setup(args):
     logging.basicConfig(level=logging.DEBUG if args.veryverbose else logging.INFO if args.verbose else logging.WARNING)
     global TYPE_PREFIX
@@ -380,109 +1280,382 @@ def initial_setup(args):
     OUTFILE_PREFIX = args.prefix
     global INITIAL_PB_PATH
     INITIAL_PB_PATH = args.mat_tree
+    global TREE_INDEX
     global INITIAL_PB_BTE
-    INITIAL_PB_BTE = bte.MATree(INITIAL_PB_PATH)
+    TREE_INDEX, INITIAL_PB_BTE = TreeIndex.for_pb(INITIAL_PB_PATH, cache_dir=args.tree_cache)
     global INITIAL_SAMPS
-    INITIAL_SAMPS = args.samples.split(',') if args.samples else sorted([leaf.id for leaf in INITIAL_PB_BTE.get_leaves()])
+    INITIAL_SAMPS = args.samples.split(',') if args.samples else sorted(TREE_INDEX.leaves())
+    global SAMPLES
+    SAMPLES = SampleRegistry(INITIAL_SAMPS, TREE_INDEX)
+    global MATRIX_ENGINE
+    MATRIX_ENGINE = args.matrix_engine
+    global CONDENSED_MATRICES
+    CONDENSED_MATRICES = args.condensed_matrix
+    global MEMMAP_DIR
+    MEMMAP_DIR = args.memmap_dir
+    global NEIGHBOR_TSV
+    NEIGHBOR_TSV = args.neighbor_tsv
+    global MATRIX_FORMAT
+    MATRIX_FORMAT = args.matrix_format
+    global MATRIX_COMPRESSION
+    MATRIX_COMPRESSION = args.matrix_compression
+    global TABLE_FORMAT
+    TABLE_FORMAT = args.table_format
+    global NEAREST_RELATIVES
+    NEAREST_RELATIVES = max(1, args.nearest_relatives)
+    global NEAREST_RELATIVES_OF_ALL
+    NEAREST_RELATIVES_OF_ALL = args.nearest_relatives_of_all
+    if TABLE_FORMAT in {'parquet', 'both'}:
+        try:
+            import polars # pylint: disable=import-outside-toplevel,import-error,unused-import
+        except ImportError as e:
+            raise ImportError(f"--table-format {TABLE_FORMAT} needs the polars module (pip install polars)") from e
+    if MATRIX_COMPRESSION == 'zstd':
+        try:
+            import zstandard # pylint: disable=import-outside-toplevel,import-error,unused-import
+        except ImportError as e:
+            raise ImportError("--matrix-compression zstd needs the zstandard module (pip install zstandard)") from e
+    global SINGLE_LINKAGE
+    SINGLE_LINKAGE = args.single_linkage
+    if not args.justmatrixandthenshutup: # -jmatsu's --distance is just the one cluster's distance
+        global CLUSTER_DISTANCES
+        CLUSTER_DISTANCES = (args.distance, *args.recursive_distance)
+        if any(bigger <= smaller for bigger, smaller in zip(CLUSTER_DISTANCES, CLUSTER_DISTANCES[1:])):
+            raise ValueError(f"--recursive-distance must be smaller than --distance and keep getting smaller, but got {CLUSTER_DISTANCES}")
+        if CLUSTER_DISTANCES != (20, 10, 5):
+            logging.warning("Clustering at %s SNPs, but process_clusters.py still expects 20, 10, and 5", CLUSTER_DISTANCES)
+    if args.artifacts:
+        global ARTIFACTS
+        ARTIFACTS = ArtifactContainer(args.artifacts)
+    global SAVE_STATE
+    SAVE_STATE = args.save_state
+    if args.previous_state:
+        # Incremental clustering never needs the whole-tree matrix, and is built on the single-linkage engine
+        global PREVIOUS_STATE
+        PREVIOUS_STATE, SINGLE_LINKAGE, MATRIX_ENGINE = args.previous_state, True, 'neighbors'
+    global WORKERS
+    WORKERS = max(1, args.workers)
+    global MATRIX_INTEGER_MAX
     if args.int8:
-        global MATRIX_INTEGER_MAX
         MATRIX_INTEGER_MAX = UINT8_MAX
+    elif args.int16:
+        MATRIX_INTEGER_MAX = UINT16_MAX
+
+def load_previous_state(previous_state_path):
+    # Last run's TreeIndex, samples, and cluster labels at each of CLUSTER_DISTANCES, or None if it wasn't clustered at those
+    with np.load(previous_state_path) as state:
+        if any(f'labels_{distance}' not in state.files for distance in CLUSTER_DISTANCES):
+            logging.warning("%s wasn't clustered at %s SNPs; clustering from scratch instead", previous_state_path, CLUSTER_DISTANCES)
+            return None
+        previous_index = TreeIndex.from_arrays(state)
+        previous_samples = np.asarray(state['samples']).tolist()
+        previous_labels = {distance: state[f'labels_{distance}'] for distance in CLUSTER_DISTANCES}
+    return previous_index, previous_samples, previous_labels
+
+def trusted_samples(previous_index: TreeIndex, previous_samples):
+    # Returns each previous sample's current SAMPLES ID (or -1 if it was removed), and which of them we can trust, or None if
+    # samples keep turning up moved.
+    #
+    # Samples that are in both runs and are still the same distance from the root keep all of their distances to each other
+    # iff the LCA depth of each consecutive pair of them (in preorder) is unchanged, checking preorder of both the old and the
+    # new tree. (The LCA of two leaves is the shallowest of the consecutive LCAs between them in preorder, and the depth of
+    # the LCA of two leaves can't be shallower than that of any consecutive LCAs between them in any other order, so this
+    # bounds every pair's old LCA depth by its new one and vice versa.) Any sample failing that check is treated as new.
+    now = np.array([SAMPLES.index.get(sample, -1) for sample in previous_samples], dtype=np.int64)
+    kept = np.flatnonzero(now >= 0)
+    old_nodes, new_nodes = previous_index.nodes_of([previous_samples[k] for k in kept]), SAMPLES.nodes[now[kept]]
+    unchanged = previous_index.depth[old_nodes] == TREE_INDEX.depth[new_nodes]
+    for _ in range(10):
+        changed = np.zeros(len(kept), dtype=bool)
+        for preorder in (np.argsort(old_nodes), np.argsort(new_nodes)):
+            preorder = preorder[unchanged[preorder]]
+            a, b = preorder[:-1], preorder[1:]
+            mismatch = previous_index.depth[previous_index.lca(old_nodes[a], old_nodes[b])] != TREE_INDEX.depth[TREE_INDEX.lca(new_nodes[a], new_nodes[b])]
+            changed[a[mismatch]], changed[b[mismatch]] = True, True
+        if not changed.any():
+            break
+        unchanged &= ~changed
+    else:
+        return None
+    trusted = np.zeros(len(previous_samples), dtype=bool) # in both runs with all the same distances to each other
+    trusted[kept[unchanged]] = True
+    return now, trusted
+
+def incremental_linkage(previous_state_path):
+    # Builds 000000's SingleLinkage mostly out of last run's clusters, so we only calculate distances for samples that are new
+    # or have moved since then. Returns None if there's too much we can't trust, in which case we just start from scratch.
+    start_time = time.time()
+    cutoff = max(CLUSTER_DISTANCES)
+    previous = load_previous_state(previous_state_path)
+    if previous is None:
+        return None
+    previous_index, previous_samples, previous_labels = previous
+    trust = trusted_samples(previous_index, previous_samples)
+    if trust is None:
+        logging.warning("Too many samples seem to have moved since %s; clustering from scratch instead", previous_state_path)
+        return None
+    now, trusted = trust
+    fresh = np.ones(len(SAMPLES), dtype=bool) # new samples, plus old ones that moved
+    fresh[now[trusted]] = False
+
+    # Last run's clusters are still clusters unless one of their samples was removed or moved, since either could have been
+    # the only thing chaining the rest together. Trusted samples in those clusters get all of their pairs recalculated.
+    top_labels = previous_labels[cutoff]
+    broken = np.unique(top_labels[~trusted & (top_labels >= 0)])
+    intact = trusted & ~np.isin(top_labels, broken)
+    edges_i, edges_j, edges_d = [], [], []
+    for distance in CLUSTER_DISTANCES:
+        # Chain each intact cluster's samples together with edges as long as the cluster distance
+        members = np.flatnonzero(intact & (previous_labels[distance] >= 0))
+        members = members[np.argsort(previous_labels[distance][members], kind='stable')]
+        same_cluster = previous_labels[distance][members[:-1]] == previous_labels[distance][members[1:]]
+        edges_i.append(now[members[:-1][same_cluster]])
+        edges_j.append(now[members[1:][same_cluster]])
+        edges_d.append(np.full(np.count_nonzero(same_cluster), distance, dtype=np.int64))
+    for label in broken.tolist():
+        members = now[trusted & (top_labels == label)]
+        pairs_i, pairs_j, pairs_d = TREE_INDEX.close_pairs(SAMPLES.nodes[members], cutoff)
+        edges_i.append(members[pairs_i])
+        edges_j.append(members[pairs_j])
+        edges_d.append(pairs_d)
+    pairs_i, pairs_j, pairs_d = TREE_INDEX.close_pairs_with(SAMPLES.nodes, np.flatnonzero(fresh), cutoff)
+    edges_i.append(pairs_i)
+    edges_j.append(pairs_j)
+    edges_d.append(pairs_d)
+    logging.info("Reused %s clusters from %s; calculated distances for %s new or moved samples and %s broken clusters in %.2f sec",
+        len(np.unique(top_labels[intact])), previous_state_path, np.count_nonzero(fresh), len(broken), time.time() - start_time)
+    return SingleLinkage(np.arange(len(SAMPLES), dtype=np.int32), np.concatenate(edges_i), np.concatenate(edges_j), np.concatenate(edges_d))
+
+def write_clustering_state(path):
+    # What incremental_linkage() needs next time: which samples we had, what they clustered into, and the tree they were on
+    labels = {distance: np.full(len(SAMPLES), -1, dtype=np.int32) for distance in CLUSTER_DISTANCES}
+    for k, cluster in enumerate(ALL_CLUSTERS):
+        if int(cluster.cluster_distance) in labels:
+            labels[int(cluster.cluster_distance)][cluster.sample_ids] = k
+    np.savez(path, samples=np.array(SAMPLES.names.tolist(), dtype=str), **{f'labels_{distance}': labels[distance] for distance in CLUSTER_DISTANCES}, **TREE_INDEX.to_arrays())
+    logging.info("Wrote clustering state to %s", path)
 
 def next_UUID():
     global CURRENT_UUID
     CURRENT_UUID += 1
     return CURRENT_UUID.copy()
 
+def next_cluster_distance(distance):
+    # The next (smaller) distance to look for subclusters at, or None if distance is already the smallest one
+    smaller = [subcluster_distance for subcluster_distance in CLUSTER_DISTANCES if subcluster_distance < distance]
+    return max(smaller) if smaller else None
+
 def get_all_20_clusters():
-    logging.debug("20 clusters are: %s", [cluster.debug_name() for cluster in ALL_CLUSTERS if cluster.cluster_distance == 20])
-    return [cluster for cluster in ALL_CLUSTERS if cluster.cluster_distance == np.uint32(20)]
+    logging.debug("20 clusters are: %s", [cluster.debug_name() for cluster in ALL_CLUSTERS if cluster.cluster_distance == CLUSTER_DISTANCES[0]])
+    return [cluster for cluster in ALL_CLUSTERS if cluster.cluster_distance == np.uint32(CLUSTER_DISTANCES[0])]
 
 def setup_clustering(distance):
     # We consider the "whole tree" stuff to be its own cluster that always will exist, which we will kick off like this
     # We will not create ANY actual clusters (20, 10, 5) with this function
-    new_cluster = Cluster(next_UUID(), INITIAL_SAMPS, distance, INITIAL_PB_BTE, subcluster=True, track_unclustered=True, writetree=True, writemax=False)
+    new_cluster = Cluster(next_UUID(), SAMPLES.ids_of(INITIAL_SAMPS), distance, subcluster=True, track_unclustered=True, writetree=True, writemax=False)
     ALL_CLUSTERS.append(new_cluster)
 
+def extract_subtrees(tree):
+    # Writes every cluster's subtree as .pb and .nwk out of the tree we already parsed for TREE_INDEX (tree is None if TREE_INDEX
+    # came from --tree-cache, in which case we only parse it here if some cluster's .pb actually has to be extracted), rather
+    # than running matUtils extract twice per cluster (which reloads the whole tree every time). bte's subtree() always returns exactly one tree, so unlike matUtils, we
+    # never end up with -subtree-N.nw files to rename. A cluster of every sample on the tree (ie 000000 without --samples) is
+    # just the tree we already have, so that one gets copied instead of extracted. The .nwk doesn't need bte at all, since
+    # TREE_INDEX can write the same Newick itself.
+    # TODO: also extract JSON version of the tree and add metadata to it (-M metadata_tsv) even though that doesn't go to MR
+    if not SUBTREES_TO_EXTRACT:
+        return
+    start_time = time.time()
+    is_leaf = TREE_INDEX.child_offsets[:-1] == TREE_INDEX.child_offsets[1:]
+    whole_tree = [len(sample_ids) == np.count_nonzero(is_leaf) and is_leaf[SAMPLES.nodes[sample_ids]].all() for _, sample_ids in SUBTREES_TO_EXTRACT]
+    if tree is None and not all(whole_tree):
+        logging.info("Loading %s to extract %s subtrees...", INITIAL_PB_PATH, len(SUBTREES_TO_EXTRACT))
+        tree = bte.MATree(INITIAL_PB_PATH)
+    clusters = {cluster.str_UUID: cluster for cluster in ALL_CLUSTERS}
+    for (str_UUID, sample_ids), is_whole_tree in zip(SUBTREES_TO_EXTRACT, whole_tree):
+        tree_outfile = f"{TYPE_PREFIX}{OUTFILE_PREFIX}{str_UUID}"
+        nodes = SAMPLES.nodes[sample_ids]
+        cluster = clusters[str_UUID]
+        if in_artifacts(cluster):
+            # bte can only save a pb to a path, so that one goes through a file on its way into the container
+            if is_whole_tree:
+                fs_op(cluster, ARTIFACTS.add_file, f"{tree_outfile}.pb", INITIAL_PB_PATH)
+            else:
+                fs_op(cluster, tree.subtree(SAMPLES.names_of(sample_ids)).save_pb, f"{tree_outfile}.pb")
+                fs_op(cluster, ARTIFACTS.add_file, f"{tree_outfile}.pb", f"{tree_outfile}.pb")
+                fs_op(cluster, os.remove, f"{tree_outfile}.pb")
+            ARTIFACTS.add(f"{tree_outfile}.nwk", (TREE_INDEX.newick(nodes) + "\n").encode("utf-8"))
+            cluster.log_fs_ops()
+            continue
+        already_exists = fs_op(cluster, os.path.exists, f"{tree_outfile}.nwk")
+        assert not already_exists, f"Tried to make subtree called {tree_outfile}.nwk but it already exists?!"
+        if is_whole_tree:
+            logging.debug("Copying %s to %s.pb since %s is the whole tree", INITIAL_PB_PATH, tree_outfile, str_UUID)
+            fs_op(cluster, shutil.copyfile, INITIAL_PB_PATH, f"{tree_outfile}.pb")
+        else:
+            logging.debug("Extracting %s pb for %s...", tree_outfile, str_UUID)
+            fs_op(cluster, tree.subtree(SAMPLES.names_of(sample_ids)).save_pb, f"{tree_outfile}.pb")
+        with fs_op(cluster, open, f"{tree_outfile}.nwk", "w", encoding="utf-8") as newick:
+            newick.write(TREE_INDEX.newick(nodes) + "\n")
+        cluster.log_fs_ops()
+    logging.info("Extracted %s subtrees in %.2f sec", len(SUBTREES_TO_EXTRACT), time.time() - start_time)
+
 def process_unclustered():
     # Should not be called if justmatrixandthenshutup
     lonely = sorted(list(UNCLUSTERED_SAMPLES))
-    for george in sorted(list(lonely)): # W0621, https://en.wikipedia.org/wiki/Lonesome_George
-        SAMPLE_CLUSTER.append(f"{george}\tlonely\n")
     with open("unclustered_samples.txt", "w", encoding="utf-8") as unclustered_samples_list:
         unclustered_samples_list.writelines(line + '\n' for line in lonely)
-    CLUSTER_SAMPLES.append(f"lonely\t{','.join(lonely)}\n")
     if len(lonely) > 0:
+        # matUtils picks some of its own output names, so it runs in a scratch directory where every file it writes is one we
+        # want, and those only get moved (atomically, with os.replace()) into the workdir once it's done
+        scratch, lonely_list = tempfile.mkdtemp(prefix="lonely_", dir="."), os.path.abspath("unclustered_samples.txt")
         handle_subprocess("Extracting a tree for lonely samples...",
-            f'matUtils extract -i "{INITIAL_PB_PATH}" -t "LONELY" -s unclustered_samples.txt -N {len(lonely)}')
-        os.rename("subtree-assignments.tsv", "lonely-subtree-assignments.tsv")
-        [os.rename(f, f[:-2] + "nwk") for f in os.listdir() if f.endswith(".nw")] # pylint: disable=expression-not-assigned
+            f'matUtils extract -i "{os.path.abspath(INITIAL_PB_PATH)}" -t "LONELY" -s "{lonely_list}" -N {len(lonely)}', workdir=scratch)
+        os.replace(os.path.join(scratch, "subtree-assignments.tsv"), "lonely-subtree-assignments.tsv")
+        for f in sorted(os.listdir(scratch)):
+            if f.endswith(".nw"):
+                os.replace(os.path.join(scratch, f), f[:-2] + "nwk")
+        shutil.rmtree(scratch)
     else:
         logging.info("Could not find any unclustered samples")
 
-    # TODO: Right now the matutils closest relatives thing extracts closest relatives for the entire tree. There isn't really
-    # a good way to calc closest relatives in a way that excludes these lads, but we could parse the TSV to remove the lines
-    # that aren't considered unclustered.
-    handle_subprocess("Geting all samples' closest relatives...",
-        f'matUtils extract -i "{INITIAL_PB_PATH}" --closest-relatives "all_closest_relatives.txt"')
+    # This used to be matUtils extract --closest-relatives, which loaded the whole tree again just to find the closest relatives
+    # of every sample on it, when it's really only the unclustered ones we don't already know the neighborhood of
+    write_nearest_relatives(SAMPLES.names.tolist() if NEAREST_RELATIVES_OF_ALL else lonely)
+
+def write_nearest_relatives(focus_samples):
+    # The NEAREST_RELATIVES closest samples on the whole tree (not just INITIAL_SAMPS, since matUtils never did that either) to
+    # each of focus_samples, one row per relative
+    start_time = time.time()
+    logging.info("Finding the %s nearest relative(s) of %s samples...", NEAREST_RELATIVES, len(focus_samples))
+    on_tree = np.flatnonzero(TREE_INDEX.child_offsets[:-1] == TREE_INDEX.child_offsets[1:])
+    nearest = TREE_INDEX.nearest(on_tree, TREE_INDEX.nodes_of(focus_samples) if focus_samples else np.array([], dtype=np.int64), NEAREST_RELATIVES)
+    columns = {
+        "sample_id": list(chain.from_iterable([sample] * len(nodes) for sample, (nodes, _) in zip(focus_samples, nearest))),
+        "nearest_relative": TREE_INDEX.node_ids[np.concatenate([nodes for nodes, _ in nearest] or [np.array([], dtype=np.int64)])].tolist(),
+        "distance": np.concatenate([distances for _, distances in nearest] or [np.array([], dtype=np.int64)])}
+    if TABLE_FORMAT in {'tsv', 'both'}:
+        write_table_tsv("nearest_relatives.tsv", columns)
+    if TABLE_FORMAT in {'parquet', 'both'}:
+        write_table_parquet("nearest_relatives.parquet", columns)
+    logging.info("Found %s nearest relatives in %.2f sec", len(columns["distance"]), time.time() - start_time)
 
-def handle_subprocess(explainer, system_call_as_string):
+def handle_subprocess(explainer, system_call_as_string, workdir=None):
     # Wrapper function matUtils subprocesses
     logging.info(explainer)
     logging.debug(system_call_as_string)
-    subprocess.run(system_call_as_string, shell=True, check=True)
+    subprocess.run(system_call_as_string, shell=True, check=True, cwd=workdir)
 
 def write_output_files():
-    # Previously we used to use CLUSTER_SAMPLES for usher extraction, but since samples can have more than one subtree
-    # assignment, we don't do that anymore. We also previously had two SAMPLE_CLUSTER files, one of which was only UUIDs
+    # Previously we used to use a cluster-to-samples TSV for usher extraction, but since samples can have more than one subtree
+    # assignment, we don't do that anymore. We also previously had two sample-to-cluster files, one of which was only UUIDs
     # (from back when UUIDs != internal cluster names) and excluded unclustered samples, but we don't have that file
     # anymore either because latest_samples.tsv (which also excludes unclustered samples) is used instead.
-    with open("cluster_annotation_workdirIDs.tsv", "a", encoding="utf-8") as samples_for_annotation:
-        samples_for_annotation.writelines(SAMPLE_CLUSTER)
-    with open("latest_clusters.tsv", "w", encoding="utf-8") as current_clusters:  # TODO: eventually add old/new samp information
-        current_clusters.writelines(LATEST_CLUSTERS)
-    with open("latest_samples.tsv", "w", encoding="utf-8") as latest_samples:  # TODO: EVENTUALLY ADD OLD/NEW SAMP INFORMATION
-        latest_samples.writelines(LATEST_SAMPLES)
+    latest_samples, latest_clusters = latest_samples_columns(), latest_clusters_columns()
+    with open("cluster_annotation_workdirIDs.tsv", "a", encoding="utf-8") as samples_for_annotation: # Nextstrain-style TSV for annotation
+        samples_for_annotation.write('Sample\tCluster\n')
+        samples_for_annotation.writelines(f"{s}\t{c}\n" for s, c in zip(latest_samples["sample_id"], latest_samples["latest_cluster_id"]))
+        samples_for_annotation.writelines(f"{george}\tlonely\n" for george in sorted(UNCLUSTERED_SAMPLES)) # https://en.wikipedia.org/wiki/Lonesome_George
+    if TABLE_FORMAT in {'tsv', 'both'}:
+        # TODO: eventually add old/new samp information
+        write_table_tsv("latest_clusters.tsv", latest_clusters, {"sample_ids": str}) # yes, a Python list repr
+        write_table_tsv("latest_samples.tsv", latest_samples)
+    if TABLE_FORMAT in {'parquet', 'both'}:
+        write_table_parquet("latest_clusters.parquet", latest_clusters)
+        write_table_parquet("latest_samples.parquet", latest_samples)
     with open("n_big_clusters", "w", encoding="utf-8") as n_cluster: n_cluster.write(str(len(get_all_20_clusters())))
     with open("n_samples_in_clusters", "w", encoding="utf-8") as n_cluded: n_cluded.write(str(len(SAMPLES_IN_ANY_CLUSTER)))
     with open("n_samples_processed", "w", encoding="utf-8") as n_processed: n_processed.write(str(len(INITIAL_SAMPS)))
     with open("n_unclustered", "w", encoding="utf-8") as n_lonely: n_lonely.write(str(len(UNCLUSTERED_SAMPLES)))
+    if SAVE_STATE:
+        write_clustering_state("clustering_state.npz")
+
+def latest_samples_columns():
+    # One row per sample per cluster it's in (excluding 000000), in the order the clusters were made. Used by the persistent ID
+    # script, so these are the same columns and dtypes process_clusters.py has always read out of latest_samples.tsv.
+    n_samples = [len(sample_ids) for _, _, sample_ids in LATEST_SAMPLES]
+    return {
+        "sample_id": SAMPLES.names_of(np.concatenate([sample_ids for _, _, sample_ids in LATEST_SAMPLES] or [np.array([], dtype=np.int32)])),
+        "cluster_distance": np.repeat(np.array([distance for _, distance, _ in LATEST_SAMPLES], dtype=np.int64), n_samples),
+        "latest_cluster_id": np.repeat(np.array([str_UUID for str_UUID, _, _ in LATEST_SAMPLES], dtype=object), n_samples).tolist()}
+
+def latest_clusters_columns():
+    # One row per cluster (excluding 000000), in the order they got their matrix_max
+    n_samples = np.array([len(sample_ids) for _, _, _, sample_ids in LATEST_CLUSTERS], dtype=np.int64)
+    return {
+        "latest_cluster_id": [str_UUID for str_UUID, _, _, _ in LATEST_CLUSTERS],
+        "current_date": [date.fromisoformat(TODAY)] * len(LATEST_CLUSTERS),
+        "cluster_distance": np.array([distance for _, distance, _, _ in LATEST_CLUSTERS], dtype=np.int64),
+        "matrix_max": np.array([matrix_max for _, _, matrix_max, _ in LATEST_CLUSTERS], dtype=np.int64),
+        "n_samples": n_samples,
+        "minimum_tree_size": n_samples,
+        "sample_ids": [SAMPLES.names_of(sample_ids) for _, _, _, sample_ids in LATEST_CLUSTERS]}
+
+def write_table_tsv(path, columns, formatters=None):
+    formatters = formatters or {}
+    with open(path, "w", encoding="utf-8") as tsv:
+        tsv.write('\t'.join(columns) + '\n')
+        formatted = []
+        for name, values in columns.items():
+            formatter = formatters.get(name, str)
+            formatted.append([formatter(value) for value in values])
+        tsv.writelines('\t'.join(row) + '\n' for row in zip(*formatted))
+
+def write_table_parquet(path, columns):
+    # polars is already in our Docker image (for process_clusters.py), and it can write the list column without pyarrow
+    # (the numpy columns are already typed; these are the ones that'd be untyped if there weren't any clusters)
+    import polars as pl # pylint: disable=import-outside-toplevel,import-error
+    python_types = {"sample_id": str, "latest_cluster_id": str, "nearest_relative": str, "current_date": date, "sample_ids": list[str]}
+    pl.DataFrame(columns, schema_overrides={name: python_types[name] for name in columns if name in python_types}).write_parquet(path)
 
-def find_neighbors(distance_matrix: np.ndarray, sample_names: list, output_tsv: str, plus_unclustered_focus: bool):
-    # Note that this REQUIRES the distance matrix and sample_names list to have the same dimensions and sample order.
-    # For this reason, to get an output that only focuses on the unclustered samples (whose closest sample may or may
-    # not be a clustered sample, ie, we don't want to just rerun this function on an unclustered-only distance matrix),
-    # we just remove rows from the pandas dataframe.
+def find_neighbors(cluster: Cluster, output_tsv: str, plus_unclustered_focus: bool):
+    # To get an output that only focuses on the unclustered samples (whose closest sample may or may not be a clustered
+    # sample, ie, we don't want to just rerun this function on an unclustered-only distance matrix), we just remove rows
+    # from the pandas dataframe.
     #
-    # Currently unused; it seems buggy...
-    logging.info("Searching for closest and furthest neighbor samples...")
-    rows = []
-    for i, sample in enumerate(sample_names):
-        distances = distance_matrix[i]
-        distances[i] = 9999999 # exclude self-self from closest by temporarily setting to something goofy
-        closest_dist = np.min(distances)
-        distances[i] = 0 # fix self-self
-        furthest_dist = np.max(distances)
-        closest_neighbors = [sample_names[j] for j in np.where(distances == closest_dist)[0]]
-        farthest_neighbors = [sample_names[j] for j in np.where(distances == furthest_dist)[0]]
-        rows.append([sample, ", ".join(closest_neighbors), closest_dist, ", ".join(farthest_neighbors), furthest_dist])
-    df = pd.DataFrame(rows, columns=["sample", "closest_neighbor(s)", "closest_distance", "furthest_sample(s)", "furthest_distance"])
-    df.to_csv(output_tsv, sep="\t", index=False)
+    # This used to overwrite the diagonal of the matrix with 9999999 (which doesn't fit in uint8/uint16) to keep self-self
+    # out of the closest distance, and it left self-self in the running for furthest; distance_extremes() masks it instead.
+    logging.info("[%s] Searching for closest and furthest neighbor samples...", cluster.debug_name())
+    closest, furthest, closest_samples, furthest_samples = cluster.distance_extremes(with_samples=True)
+    names = np.array(cluster.samples, dtype=object)
+    df = pd.DataFrame({
+        "sample": cluster.samples,
+        "closest_neighbor(s)": [", ".join(names[js]) for js in closest_samples],
+        "closest_distance": closest,
+        "furthest_sample(s)": [", ".join(names[js]) for js in furthest_samples],
+        "furthest_distance": furthest})
+    fs_op(cluster, df.to_csv, output_tsv, sep="\t", index=False)
     if plus_unclustered_focus:
         filtered_rows = df[df["sample"].isin(UNCLUSTERED_SAMPLES)]
-        filtered_rows.to_csv("unclustered_neighbors.tsv", sep="\t", index=False)
+        fs_op(cluster, filtered_rows.to_csv, "unclustered_neighbors.tsv", sep="\t", index=False)
 
 def main():
     parser = argparse.ArgumentParser(description="Clusterf...inder")
     parser.add_argument('mat_tree', type=str, help='input MAT (.pb)')
     parser.add_argument('-s', '--samples', required=False, type=str,help='comma separated list of samples')
     parser.add_argument('-d', '--distance', default=20, type=int, help='max distance between samples to identify as clustered')
-    parser.add_argument('-rd', '--recursive-distance', type=lambda x: [int(i) for i in x.strip('"').split(',')], help='after identifying --distance cluster, search for subclusters with these distances')
+    parser.add_argument('-rd', '--recursive-distance', default='10,5', type=lambda x: [int(i) for i in x.strip('"').split(',')], help='after identifying --distance cluster, search for subclusters with these distances, each smaller than the last (with --single-linkage, every extra distance is just another cut of the same spanning forest)')
     parser.add_argument('-t', '--type', choices=['BM', 'NB'], type=str.upper, help='BM=backmasked, NB=not-backmasked; will add BM/NB before prefix')
     parser.add_argument('-cn', '--collection-name', default='unnamed', type=str, help='name of this group of samples (do not include a/b prefix)')
     parser.add_argument('-sf', '--startfrom', default=0, type=int, help='the six-digit int part of cluster UUIDs will begin with the next integer after this one')
     parser.add_argument('-p', '--prefix', default='workdir', type=str, help='prefix outfiles with this string (will come AFTER a/b type prefix)')
-    parser.add_argument('-i8', '--int8', action='store_true', help='[untested, not recommended] store distance matrix as 8-bit unsigned integers to save as much memory as possible')
-    parser.add_argument('-i16', '--int16', action='store_true', help='[untested] store distance matrix as 16-bit unsigned integers to save memory')
+    parser.add_argument('-i8', '--int8', action='store_true', help='[deprecated] matrices now automatically use the smallest unsigned int that fits their distances; this only warns if a matrix needs more than 8 bits')
+    parser.add_argument('-i16', '--int16', action='store_true', help='[deprecated] matrices now automatically use the smallest unsigned int that fits their distances; this only warns if a matrix needs more than 16 bits')
+    parser.add_argument('-me', '--matrix-engine', choices=['rows', 'blocks', 'neighbors'], default='rows', help='how to fill the whole-tree (000000) matrix: rows=one vectorized LCA query per row, blocks=one post-order tree traversal writing subtree-vs-subtree blocks, neighbors=skip the matrix entirely and only search the tree for pairs within --distance')
+    parser.add_argument('-cm', '--condensed-matrix', action='store_true', help='store only the upper triangle of each distance matrix (halves memory; TSV outputs are unchanged)')
+    parser.add_argument('-mm', '--memmap-dir', type=str, help='back the whole-tree (000000) matrix with a memory-mapped file in this directory (ideally local SSD) so it does not need to fit in RAM')
+    parser.add_argument('-mf', '--matrix-format', choices=['tsv', 'npy', 'both'], default='tsv', help='write each distance matrix as a _dmtrx.tsv, as a _dmtrx.npy (memory-mappable, with its sample order in _dmtrx.samples.txt), or both')
+    parser.add_argument('-mc', '--matrix-compression', choices=['gzip', 'zstd'], help='compress the whole-tree (000000) matrix as it is written, as _dmtrx.tsv.gz or _dmtrx.tsv.zst (other matrices stay plain TSVs for process_clusters.py)')
+    parser.add_argument('-tf', '--table-format', choices=['tsv', 'parquet', 'both'], default='tsv', help='write latest_samples and latest_clusters as TSVs, as typed Parquet tables (needs polars), or both')
+    parser.add_argument('-nr', '--nearest-relatives', default=1, type=int, help='how many of each unclustered sample\'s closest samples on the tree (plus any tied with the last one) to write to nearest_relatives.tsv')
+    parser.add_argument('-nra', '--nearest-relatives-of-all', action='store_true', help='write every sample\'s nearest relatives to nearest_relatives.tsv, not just the unclustered samples\'')
+    parser.add_argument('-nt', '--neighbor-tsv', action='store_true', help='write every sample\'s closest and furthest samples (from the whole-tree matrix) to a TSV, plus unclustered_neighbors.tsv for just the unclustered samples')
+    parser.add_argument('-sl', '--single-linkage', action='store_true', help='find the pairs within the largest cluster distance once, build their minimum spanning forest, and cut every level of clusters out of that instead of searching each cluster\'s matrix for neighbors')
+    parser.add_argument('-ps', '--previous-state', type=str, help='clustering_state.npz from a previous run on (ideally) the same base tree; only distances involving samples that are new or have moved since then will be calculated (implies --single-linkage and --matrix-engine neighbors)')
+    parser.add_argument('-ss', '--save-state', action='store_true', help='write clustering_state.npz, which a later run can use as its --previous-state')
+    parser.add_argument('-tc', '--tree-cache', type=str, help='directory (that outlives this run) to cache mat_tree\'s tree index in, keyed by its hash, so later runs on the same tree can memory-map it instead of indexing mat_tree again (mat_tree itself is then only parsed if a cluster\'s subtree .pb needs extracting)')
+    parser.add_argument('-a', '--artifacts', type=str, help='write every cluster\'s outputs (except 000000\'s) into this uncompressed zip, under the names they\'d otherwise have as separate files, instead of into the workdir')
+    parser.add_argument('-w', '--workers', default=1, type=int, help='number of processes to calculate the whole-tree (000000) matrix with (rows engine only), and to build 20-clusters and their subclusters with')
     parser.add_argument('-v', '--verbose', action='store_true', help='enable info logging')
     parser.add_argument('-vv', '--veryverbose', action='store_true', help='enable debug logging')
 
@@ -492,10 +1665,13 @@ def main():
     initial_setup(args)
     if args.justmatrixandthenshutup:
         # just writes the distance matrix and maximum distance to the disk
-        Cluster(args.collection_name, INITIAL_SAMPS, args.distance, INITIAL_PB_BTE, subcluster=False, track_unclustered=False, writetree=False, writemax=True)
+        with ARTIFACTS or nullcontext():
+            Cluster(args.collection_name, SAMPLES.ids_of(INITIAL_SAMPS), args.distance, subcluster=False, track_unclustered=False, writetree=False, writemax=True)
     else:
         # will write distance matrixes and subtrees, but not maximum distance (since maximum distance is recorded in LATEST_CLUSTERS)
-        setup_clustering(UINT32_MAX)
+        with ARTIFACTS or nullcontext():
+            setup_clustering(UINT32_MAX)
+            extract_subtrees(INITIAL_PB_BTE)
         process_unclustered()
         write_output_files()
 
@@ -10,6 +10,9 @@ VERSION="0.0.2"
 # pylint: disable=missing-function-docstring,broad-exception-caught,wrong-import-position
 import json
 import sys
+import shutil
+import zipfile
+from contextlib import nullcontext
 from pathlib import Path
 import argparse
 from concurrent.futures import ThreadPoolExecutor
@@ -17,10 +20,18 @@ from concurrent.futures import ThreadPoolExecutor
 MAX_WORKERS = 8 
 
 
-def rename_file(workdir_id, cluster_id, extension):
+def rename_file(workdir_id, cluster_id, extension, artifacts=None, artifact_names=frozenset()):
     old_filename = Path(f"aworkdir{workdir_id}{extension}")
     new_filename = Path(f"a{cluster_id}{extension}")
     
+    if old_filename.name in artifact_names:
+        # the backup tarballs want loose files, so this is where find_clusters.py's --artifacts finally get extracted
+        try:
+            with artifacts.open(old_filename.name) as member, open(new_filename, "wb") as out:
+                shutil.copyfileobj(member, out)
+            return f"{artifacts.filename}:{old_filename} -> {new_filename}"
+        except Exception as e:
+            return f"Error extracting {old_filename} from {artifacts.filename} to {new_filename}: {e}"
     if old_filename.exists():
         try:
             old_filename.rename(new_filename)
@@ -32,6 +43,7 @@ def rename_file(workdir_id, cluster_id, extension):
 def main():
     parser = argparse.ArgumentParser(description="Mass rename files from find_clusters.py into their persistent ID names post process_clusters.py")
     parser.add_argument('--json', type=str, required=False, help="path to all_cluster_information JSON")
+    parser.add_argument('--artifacts', type=str, required=False, help="find_clusters.py's --artifacts zip, if it was used (its members get extracted under their persistent ID names)")
     parser.add_argument('--verbose', action='store_true', help="print all renames (recommended unless your logger is extremely slow)")
     args = parser.parse_args()
 
@@ -56,20 +68,23 @@ def main():
 
     print(f"Loaded {len(id_map)} mappings. Starting renaming...", file=sys.stderr)
 
-    for extension in [".nwk", "_dmtrx.tsv", ".pb"]:
+    with zipfile.ZipFile(args.artifacts, "r") if args.artifacts else nullcontext() as artifacts:
+        artifact_names = frozenset(artifacts.namelist()) if artifacts is not None else frozenset()
+
+        for extension in [".nwk", "_dmtrx.tsv", "_dmtrx.npy", "_dmtrx.samples.txt", ".pb"]:
 
-        # multi-threaded renaming, just for fun!
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            futures = [
-                executor.submit(rename_file, workdir_id, cluster_id, extension) 
-                for workdir_id, cluster_id in id_map.items()
-            ]
+            # multi-threaded renaming, just for fun!
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(rename_file, workdir_id, cluster_id, extension, artifacts, artifact_names) 
+                    for workdir_id, cluster_id in id_map.items()
+                ]
             
-            for i, future in enumerate(futures):
-                result = future.result()
-                print(result)
-                if len(id_map) >= 500 and i % 500 == 0:
-                    print(f"Progress: Processed {i} files...", file=sys.stderr)
+                for i, future in enumerate(futures):
+                    result = future.result()
+                    print(result)
+                    if len(id_map) >= 500 and i % 500 == 0:
+                        print(f"Progress: Processed {i} files...", file=sys.stderr)
     
     print("Finished renaming files", file=sys.stderr)
 
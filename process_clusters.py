@@ -5,11 +5,17 @@ import sys
 import json
 import time
 import random
+import shutil
 import logging
 import argparse
+import tempfile
+import zipfile
 from datetime import datetime, timezone
+from contextlib import nullcontext
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import requests
+import numpy as np
 import polars as pl
 import polars.selectors as cs
 from polars.testing import assert_series_equal
@@ -59,6 +65,7 @@ today = datetime.now(timezone.utc) # I don't care if this runs past midnight, gi
 print(f"It's {today} in Thurles right now. Up Tipp!")
 max_random_id_attempts = 500 # maximum attempts to fix invalid cluster IDs
 FIND_CLUSTERS_OUTFILE_PREFIX = "workdir"
+ARTIFACTS = None # zipfile.ZipFile of find_clusters.py's --artifacts, if we got one (see open_artifact())
 MR_METADATA_COLUMNS_DEFAULT = "Epi_Duplication,Year_Collected,Patient_County,State,Country,20_Cluster_Date,10_Cluster_Date,5_Cluster_Date,Latitude,Longitude,Submitter_Facility,Submitter_Facility_Sample_ID,Sequencing_Facility"
 SNP_DISTANCES = [20,10,5] # mostly unused, eventually this would ideally be an input arg
 SEQUENTIAL_DEBUG_IDENTIFIER = "Z" # see debugid()
@@ -86,8 +93,8 @@ def main():
     parser.add_argument('-s', '--shareemail', type=str, required=False, help="email (just one) for calling MR share API")
     parser.add_argument('-to', '--token', type=str, required=False, help="TXT: MR token")
     parser.add_argument('-as', '--allsamples', type=str, required=False, help='comma-delimited list of samples to consider for clustering (if absent, will do entire tree)')
-    parser.add_argument('-ls', '--latestsamples', type=str, help='TSV: latest sample information (as identified by find_clusters.py)')
-    parser.add_argument('-lm', '--latestclustermeta', type=str, required=False, help='TSV: metadata from find_clusters.py (only used for matrix_max)')
+    parser.add_argument('-ls', '--latestsamples', type=str, help='TSV or Parquet: latest sample information (as identified by find_clusters.py)')
+    parser.add_argument('-lm', '--latestclustermeta', type=str, required=False, help='TSV or Parquet: metadata from find_clusters.py (only used for matrix_max)')
     parser.add_argument('-sm', '--samplemeta', type=str, required=False, help='TSV: sample metadata pulled from terra (including myco outs), one line per sample')
     parser.add_argument('-mc', '--mr_metadata_columns', type=str, 
         default=MR_METADATA_COLUMNS_DEFAULT, 
@@ -108,11 +115,19 @@ def main():
     parser.add_argument('--mr_decimated_template', type=str, help="JSON: template file for in-use MR projects which have since lost all of their samples")
     parser.add_argument('--no_upload_childless_20s', action='store_true', help="do not upload 20-clusters to MR if they have no children (ie, no subclusters)")
     parser.add_argument('--skip_perl', action='store_true', help="skip the perl scripts to debug using existing rosetta_20/10/5 files (don't enable this for real runs!)")
+    parser.add_argument('--backmask_workers', type=int, default=1, help="number of clusters to backmask at once (each one runs matUtils and find_clusters.py in its own scratch directory, and matUtils gets an even share of the CPUs)")
+    parser.add_argument('--artifacts', type=str, help="ZIP: find_clusters.py's --artifacts container, which cluster subtrees and matrices will be read from (instead of the workdir) if they're in it")
     parser.add_argument('--optional_mr_outputs', action='store_true', help="if subtree or distance matrix fail to generate, just throw a warning instead of erroring")
     parser.add_argument('--debug_mr_json', action='store_true', help='even without MR token, attempt to generate MR project JSONs')
 
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, force=True)
+    global ARTIFACTS
+    # Opening the zip only reads its central directory; members are read when asked for (see open_artifact())
+    with zipfile.ZipFile(args.artifacts, "r") if args.artifacts else nullcontext() as ARTIFACTS:
+        process(args)
+
+def process(args):
     logging.getLogger("urllib3").setLevel(logging.WARNING)
     logging.getLogger("requests").setLevel(logging.WARNING)
     
@@ -175,9 +190,7 @@ def main():
         logging.warning("No sample metadata passed in")
         all_samples_metadata = None
 
-    all_latest_samples = pl.read_csv(args.latestsamples,
-        separator="\t", 
-        schema_overrides={"latest_cluster_id": pl.Utf8}).filter(pl.col("latest_cluster_id").is_not_null())
+    all_latest_samples = read_latest_table(args.latestsamples).filter(pl.col("latest_cluster_id").is_not_null())
     debug_logging_handler_df("Loaded all_latest_samples", all_latest_samples, "01")
 
     if not start_over:
@@ -909,7 +922,7 @@ def main():
     # Latest cluster meta is only used for matrix_max
     if args.latestclustermeta:
         debug_logging_handler_txt("Adding matrix_max metadata from args.latestclustermeta...", "09", 20)
-        latest_clusters_meta = pl.read_csv(args.latestclustermeta, separator="\t", schema_overrides={"latest_cluster_id": pl.Utf8})
+        latest_clusters_meta = read_latest_table(args.latestclustermeta)
         latest_clusters_meta = latest_clusters_meta.rename({'latest_cluster_id': 'workdir_cluster_id'})
         latest_clusters_meta = latest_clusters_meta.select(['workdir_cluster_id', 'matrix_max'])
 
@@ -1762,6 +1775,13 @@ def read_rosetta_stone(filename: str, cluster_distance: int, retries=0) -> pl.Da
     assert rosetta_df["latest_cluster_id"].is_unique().all(), f"Duplicate latest_cluster_id found rosetta_{cluster_distance}: {rosetta_df}"
     return rosetta_df
 
+def read_latest_table(filename: str) -> pl.DataFrame:
+    # find_clusters.py's latest_samples/latest_clusters. The Parquet versions already have their dtypes (including keeping the
+    # leading zeroes on latest_cluster_id) so they're read as-is; the TSVs need to be told not to turn UUIDs into integers.
+    if filename.endswith(".parquet"):
+        return pl.read_parquet(filename)
+    return pl.read_csv(filename, separator="\t", schema_overrides={"latest_cluster_id": pl.Utf8})
+
 def build_sample_map(dataframe: pl.DataFrame):
     sample_map = {dist: {} for dist in SNP_DISTANCES}
     for row in dataframe.iter_rows(named=True):
@@ -1802,6 +1822,7 @@ def establish_parenthood(dataframe: pl.DataFrame, sample_map: list, logfile: str
 
 def get_nwks_matrices_and_max(big_ol_dataframe: pl.DataFrame, combineddiff: str, args, logfile: str) -> pl.DataFrame:
     big_ol_dataframe = add_cols_if_not_there(big_ol_dataframe, ["a_matrix", "a_tree", "b_matrix", "b_tree", "b_max"])
+    to_backmask = {} # cluster ID --> that cluster's (not backmasked) subtree pb
     for row in big_ol_dataframe.iter_rows(named=True):
         this_cluster_id = row["cluster_id"]
         workdir_cluster_id = row["workdir_cluster_id"]
@@ -1810,75 +1831,111 @@ def get_nwks_matrices_and_max(big_ol_dataframe: pl.DataFrame, combineddiff: str,
             debug_logging_handler_txt(f"[{this_cluster_id}] Decimated cluster, skipping...", logfile, 20)
         elif workdir_cluster_id is not None:
             
-            # matrix
-            hypothetical_amatrix = f"a{FIND_CLUSTERS_OUTFILE_PREFIX}{workdir_cluster_id}_dmtrx.tsv"
-            if os.path.exists(hypothetical_amatrix):
-                amatrix = hypothetical_amatrix
+            # matrix (find_clusters.py may have written it as a TSV, an npy, or both)
+            hypothetical_amatrix = f"a{FIND_CLUSTERS_OUTFILE_PREFIX}{workdir_cluster_id}_dmtrx"
+            amatrix = find_matrix(hypothetical_amatrix)
+            if amatrix is not None:
                 big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "a_matrix", amatrix)
             else:
-                amatrix = None
-                debug_logging_handler_txt(f"[{this_cluster_id}] Couldn't find {hypothetical_amatrix}", logfile, 30)
+                debug_logging_handler_txt(f"[{this_cluster_id}] Couldn't find {hypothetical_amatrix}.npy or {hypothetical_amatrix}.tsv", logfile, 30)
             
             # subtree (nwk)
             hypothetical_atree = f"a{FIND_CLUSTERS_OUTFILE_PREFIX}{workdir_cluster_id}.nwk"
-            if os.path.exists(hypothetical_atree):
+            if artifact_exists(hypothetical_atree):
                 atree = hypothetical_atree
                 big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "a_tree", atree)
             else:
                 atree = None
                 debug_logging_handler_txt(f"[{this_cluster_id}] Couldn't find {hypothetical_amatrix}", logfile, 30)
 
-            # Now deal with the b-sides
-            btree = bmatrix = bmax = None
+            # Now deal with the b-sides, which get backmasked all at once after this loop
             if atree is not None:
                 hypothetical_atreepb = f"a{FIND_CLUSTERS_OUTFILE_PREFIX}{workdir_cluster_id}.pb"
-                if not os.path.exists(hypothetical_atreepb) and not args.optional_mr_outputs:
+                if not artifact_exists(hypothetical_atreepb) and not args.optional_mr_outputs:
                     debug_logging_handler_txt(f"[{this_cluster_id}] found atree, but not the pb (looked for {hypothetical_atreepb})", logfile, 40)
                     exit(1)
-                elif os.path.exists(hypothetical_atreepb):
-                    atreepb = hypothetical_atreepb
-                    hypothetical_btreepb = f"b{this_cluster_id}.pb"
-                    hypothetical_btree = f"b{this_cluster_id}.nwk"
-                    hypothetical_bmatrix = f"b{this_cluster_id}_dmtrx.tsv"
-                    hypothetical_bmax = f"b{this_cluster_id}.int"
-                    btreepb = generate_backmasked_file(f"matUtils mask -i {atreepb} -o {hypothetical_btreepb} -D 1000 -f {combineddiff}", 
-                        hypothetical_btreepb, this_cluster_id, args)
-                    btree = generate_backmasked_file(f"matUtils extract -i {btreepb} -t {hypothetical_btree}", 
-                        hypothetical_btree, this_cluster_id, args)
-                    bmatrix = generate_backmasked_file(f"python3 {SCRIPT_PATH}/find_clusters.py {btreepb} --type BM --prefix '' --collection-name {this_cluster_id} --distance {UINT32_MAX_MINUS_ONE} -jmatsu", 
-                        hypothetical_bmatrix, this_cluster_id, args)
-                    if os.path.isfile(hypothetical_bmax):
-                        with open(hypothetical_bmax, "r", encoding="utf-8") as bmaxfile:
-                            bmax = int(bmaxfile.read().strip())
-                    elif args.optional_mr_outputs:
-                        bmax = -1
-                    else:
-                        raise ValueError(f"Couldn't find backmasked matrix_max at {hypothetical_bmax}")
+                elif artifact_exists(hypothetical_atreepb):
+                    to_backmask[this_cluster_id] = hypothetical_atreepb
                 else:
                     # args.optional_mr_outputs was made for bmatrix_max, not the other bsides, so the script will likely crash
                     # once get_btree_raw() tries to open a file that doesn't exist. I might need a better toggle for backmasking,
                     # since it's so slow anyway... hmmm
                     bmax = -1
                     debug_logging_handler_txt(f"[{this_cluster_id}] found atree, but not the pb (looked for {hypothetical_atreepb}), will continue without backmasking due to --optional_mr_outputs (will likely crash anyway)", logfile, 30)
-                big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_matrix", bmatrix)
-                big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_tree", btree)
-                big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_max", bmax)
+                    big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_matrix", None)
+                    big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_tree", None)
+                    big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_max", bmax)
 
         else:
             debug_logging_handler_txt(f"Found cluster {this_cluster_id} with None workdir ID, but also not flagged as decimated?", logfile, 40)
             exit(1)
+
+    # Each cluster's backmasking is three subprocesses that each load a tree, so this is where most of our time goes. Since
+    # every cluster gets its own scratch directory (see backmask_cluster()) they can all run at the same time.
+    debug_logging_handler_txt(f"Backmasking {len(to_backmask)} clusters with {args.backmask_workers} workers...", logfile, 20)
+    with ThreadPoolExecutor(max_workers=max(1, args.backmask_workers)) as pool:
+        futures = {this_cluster_id: pool.submit(backmask_cluster, this_cluster_id, atreepb, combineddiff, args) for this_cluster_id, atreepb in to_backmask.items()}
+        done, not_done = wait(futures.values(), return_when=FIRST_EXCEPTION)
+        for future in done:
+            if future.exception() is not None:
+                # We're going down, so don't start backmasking anything else (clusters already running still finish)
+                for pending in not_done:
+                    pending.cancel()
+                raise future.exception()
+        for this_cluster_id, future in futures.items():
+            btree, bmatrix, bmax = future.result()
+            big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_matrix", bmatrix)
+            big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_tree", btree)
+            big_ol_dataframe = update_cluster_column(big_ol_dataframe, this_cluster_id, "b_max", bmax)
     return big_ol_dataframe
 
-def generate_backmasked_file(command, output_path, this_cluster_id, args):
+def backmask_cluster(this_cluster_id, atreepb, combineddiff, args):
+    # Masks one cluster's subtree, then gets its nwk, distance matrix, and matrix max. matUtils and find_clusters.py both write
+    # whatever files they like into their working directory, so they run in a scratch directory that only this cluster uses,
+    # and finished files only get moved into the workdir (atomically, with os.replace()) once everything is done.
+    # Returns the b-side nwk, matrix, and matrix max (the file names are None if they couldn't be made with --optional_mr_outputs).
+    btreepb, btree, bmatrix, bmaxfile = f"b{this_cluster_id}.pb", f"b{this_cluster_id}.nwk", f"b{this_cluster_id}_dmtrx.npy", f"b{this_cluster_id}.int"
+    combineddiff = os.path.abspath(combineddiff) if combineddiff is not None else None
+    scratch = tempfile.mkdtemp(prefix=f"backmask_{this_cluster_id}_", dir=".")
+    threads = max(1, (os.cpu_count() or 1) // max(1, args.backmask_workers)) # so matUtils in every worker doesn't try to use every CPU
+    try:
+        if in_artifacts(atreepb):
+            # matUtils needs a real file, so this is the one artifact that gets copied out of the container (into scratch)
+            with open_artifact(atreepb) as member, open(os.path.join(scratch, atreepb), "wb") as copied:
+                shutil.copyfileobj(member, copied)
+            atreepb = os.path.join(scratch, atreepb)
+        atreepb = os.path.abspath(atreepb)
+        btreepb = generate_backmasked_file(f"matUtils mask -i {atreepb} -o {btreepb} -D 1000 -f {combineddiff} -T {threads}",
+            btreepb, this_cluster_id, args, scratch)
+        btree = generate_backmasked_file(f"matUtils extract -i {btreepb} -t {btree} -T {threads}",
+            btree, this_cluster_id, args, scratch)
+        bmatrix = generate_backmasked_file(f"python3 {SCRIPT_PATH}/find_clusters.py {btreepb} --type BM --prefix '' --collection-name {this_cluster_id} --distance {UINT32_MAX_MINUS_ONE} --matrix-format npy -jmatsu",
+            bmatrix, this_cluster_id, args, scratch)
+        if os.path.isfile(os.path.join(scratch, bmaxfile)):
+            with open(os.path.join(scratch, bmaxfile), "r", encoding="utf-8") as f:
+                bmax = int(f.read().strip())
+        elif args.optional_mr_outputs:
+            bmax, bmaxfile = -1, None
+        else:
+            raise ValueError(f"Couldn't find backmasked matrix_max at {bmaxfile}")
+        for finished in (btreepb, btree, bmatrix, matrix_sidecar(bmatrix) if bmatrix is not None else None, bmaxfile):
+            if finished is not None:
+                os.replace(os.path.join(scratch, finished), finished)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    return btree, bmatrix, bmax
+
+def generate_backmasked_file(command, output_path, this_cluster_id, args, workdir="."):
+    # output_path is relative to workdir, which is also where command runs
     try:
         # command can be matUtils mask, matUtils extract, or find_clusters.py
-        subprocess.run(command, shell=True, check=True)
+        subprocess.run(command, shell=True, check=True, cwd=workdir)
     except subprocess.CalledProcessError as e:
         if args.optional_mr_outputs:
             logging.warning("[%s] Failed to generate locally-masked tree/matrix: %s", this_cluster_id, e.output)
             return None
         raise ValueError from e
-    if not os.path.isfile(output_path):
+    if not os.path.isfile(os.path.join(workdir, output_path)):
         if args.optional_mr_outputs:
             logging.warning("[%s] Command <%s> returned 0 but expected output %s doesn't exist", this_cluster_id, command, output_path)
             return None
@@ -2157,13 +2214,13 @@ def create_new_mr_project(token, this_cluster_id, mr_blank_template, retries=-1)
 def get_atree_raw(cluster_name: str, big_ol_dataframe: pl.DataFrame):
     atree_series = big_ol_dataframe.filter(pl.col("cluster_id") == cluster_name).select("a_tree")
     atree = atree_series.item()
-    with open(atree, "r", encoding="utf-8") as nwk_file:
+    with io.TextIOWrapper(open_artifact(atree), encoding="utf-8") as nwk_file:
         return nwk_file.readline() # only need first line
 
 def get_btree_raw(cluster_name: str, big_ol_dataframe: pl.DataFrame):
     btree_series = big_ol_dataframe.filter(pl.col("cluster_id") == cluster_name).select("b_tree")
     btree = btree_series.item()
-    with open(btree, "r", encoding="utf-8") as nwk_file:
+    with io.TextIOWrapper(open_artifact(btree), encoding="utf-8") as nwk_file:
         return nwk_file.readline() # only need first line
 
 def nullfill_LR(polars_df: pl.DataFrame, left_col: str, right_col:str) -> pl.DataFrame:
@@ -2184,16 +2241,58 @@ def generate_truly_unique_cluster_id(existing_ids, denylist):
 def get_amatrix_raw(cluster_name: str, big_ol_dataframe: pl.DataFrame):
     amatrix_series = big_ol_dataframe.filter(pl.col("cluster_id") == cluster_name).select("a_matrix")
     amatrix = amatrix_series.item()
-    with open(amatrix, "r", encoding="utf-8") as distance_matrix:
-        this_a_matrix = distance_matrix.readlines()
-    return this_a_matrix
+    return read_matrix_lines(amatrix)
 
 def get_bmatrix_raw(cluster_name: str, big_ol_dataframe: pl.DataFrame):
     bmatrix_series = big_ol_dataframe.filter(pl.col("cluster_id") == cluster_name).select("b_matrix")
     bmatrix = bmatrix_series.item()
-    with open(bmatrix, "r", encoding="utf-8") as distance_matrix:
-        this_b_matrix = distance_matrix.readlines()
-    return this_b_matrix
+    return read_matrix_lines(bmatrix)
+
+def find_matrix(matrix_base: str):
+    # find_clusters.py writes matrices as matrix_base.tsv, matrix_base.npy (plus matrix_base.samples.txt), or both; we'd
+    # rather have the npy since it doesn't need parsing. Returns None if neither exists.
+    if artifact_exists(f"{matrix_base}.npy") and artifact_exists(matrix_sidecar(f"{matrix_base}.npy")):
+        return f"{matrix_base}.npy"
+    if artifact_exists(f"{matrix_base}.tsv"):
+        return f"{matrix_base}.tsv"
+    return None
+
+def matrix_sidecar(npy_matrix: str):
+    # Sample names, one per line, in the same order as the npy matrix's rows and columns
+    return npy_matrix[:-len(".npy")] + ".samples.txt"
+
+def read_matrix_lines(matrix: str) -> list[str]:
+    # Returns what readlines() on the matrix TSV would. If the matrix is an npy, this is the only time it gets turned into text.
+    if not matrix.endswith(".npy"):
+        with io.TextIOWrapper(open_artifact(matrix), encoding="utf-8") as distance_matrix:
+            return distance_matrix.readlines()
+    if in_artifacts(matrix):
+        with open_artifact(matrix) as member:
+            distances = np.load(member)
+    else:
+        distances = np.load(matrix, mmap_mode="r")
+    with io.TextIOWrapper(open_artifact(matrix_sidecar(matrix)), encoding="utf-8") as sidecar:
+        samples = sidecar.read().splitlines()
+    return ['sample\t' + '\t'.join(samples) + '\n'] + [f"{sample}\t" + '\t'.join(str(distance) for distance in row.tolist()) + '\n' for sample, row in zip(samples, distances)]
+
+def in_artifacts(name: str) -> bool:
+    if ARTIFACTS is None:
+        return False
+    try:
+        ARTIFACTS.getinfo(name) # dict lookup, not a scan
+    except KeyError:
+        return False
+    return True
+
+def artifact_exists(name: str) -> bool:
+    # find_clusters.py's outputs are either in the workdir or (with --artifacts) in its container; the b-sides are always files
+    return in_artifacts(name) or os.path.exists(name)
+
+def open_artifact(name: str):
+    # Binary file object for one of find_clusters.py's outputs, read straight out of the container if that's where it is
+    if in_artifacts(name):
+        return ARTIFACTS.open(name)
+    return open(name, "rb") # pylint: disable=consider-using-with
 
 def get_cluster_ids_for_sample(df: pl.DataFrame, sample_id: str) -> list[str]:
     return (
@@ -0,0 +1,228 @@
+"""
+Checks every matrix/clustering engine in find_clusters.py against the original row-by-row engine on randomly generated trees.
+The trees are built straight into a TreeIndex, so nothing here parses a .pb, but find_clusters.py still imports bte.
+
+Run with: python -m pytest test_find_clusters.py
+"""
+# pylint: disable=missing-function-docstring,redefined-outer-name
+import re
+import logging
+from itertools import count
+import numpy as np
+import pytest
+
+pytest.importorskip("bte")
+import find_clusters as fc # pylint: disable=wrong-import-position
+
+BRANCH_LENGTHS = [0, 0, 1, 1, 2, 3, 5, 8, 15, 30] # short enough to get plenty of 20, 10, and 5 clusters
+
+def random_clade(rng, n_leaves, leaf_names, internal_names):
+    # [name, branch length, children] with n_leaves leaves and no unary nodes
+    if n_leaves == 1:
+        return [f"S{next(leaf_names):04d}", int(rng.choice(BRANCH_LENGTHS)), []]
+    cuts = np.sort(rng.choice(np.arange(1, n_leaves), size=min(int(rng.choice([1, 1, 1, 2, 3])), n_leaves - 1), replace=False))
+    sizes = np.diff(np.concatenate(([0], cuts, [n_leaves]))).tolist()
+    return [f"node_{next(internal_names)}", int(rng.choice(BRANCH_LENGTHS)), [random_clade(rng, size, leaf_names, internal_names) for size in sizes]]
+
+def random_tree(seed, n_leaves):
+    return random_clade(np.random.default_rng(seed), n_leaves, count(1), count(1))
+
+def tree_index(clade):
+    # TreeIndex() wants every node in preorder
+    node_ids, parent, depth, stack = [], [], [], [(clade, -1)]
+    while stack:
+        (name, length, children), p = stack.pop()
+        node_ids.append(name)
+        parent.append(p)
+        depth.append(0 if p < 0 else depth[p] + length)
+        stack.extend((child, len(node_ids) - 1) for child in reversed(children))
+    return fc.TreeIndex(node_ids, np.array(parent), np.array(depth))
+
+def leaves(clade):
+    return [clade[0]] if not clade[2] else [leaf for child in clade[2] for leaf in leaves(child)]
+
+def remove_leaf(clade, name):
+    # ...along with any internal node that's left without children, since that would look like a sample
+    for child in clade[2]:
+        remove_leaf(child, name)
+    clade[2] = [child for child in clade[2] if child[0] != name and (child[2] or not child[0].startswith("node_"))]
+
+def internal_nodes(clade):
+    return [clade] + [node for child in clade[2] if child[2] for node in internal_nodes(child)] if clade[2] else []
+
+def parse_newick(newick):
+    # node_ids, parent, and depth in preorder, just like tree_index() makes
+    node_ids, parent, length, stack, last = [], [], [], [], None
+    for token in re.findall(r"[(),;]|[^(),;]+", newick):
+        if token == "(":
+            node_ids.append(None)
+            parent.append(stack[-1] if stack else -1)
+            length.append(0)
+            stack.append(len(node_ids) - 1)
+            last = None
+        elif token == ")":
+            last = stack.pop()
+        elif token in {",", ";"}:
+            last = None
+        else:
+            name, _, branch = token.partition(":")
+            if last is None:
+                node_ids.append(name)
+                parent.append(stack[-1] if stack else -1)
+                length.append(int(branch or 0))
+            else:
+                node_ids[last], length[last] = name, int(branch or 0)
+    depth = []
+    for p, branch in zip(parent, length):
+        depth.append(0 if p < 0 else depth[p] + branch)
+    return fc.TreeIndex(node_ids, np.array(parent), np.array(depth))
+
+def pairwise(index, names):
+    nodes = index.nodes_of(names)
+    return index.distances(nodes[:, None], nodes[None, :])
+
+def assert_same_run(actual, expected):
+    (clusters, unclustered, matrices), (expected_clusters, expected_unclustered, expected_matrices) = actual, expected
+    assert clusters == expected_clusters
+    assert unclustered == expected_unclustered
+    assert matrices.keys() == expected_matrices.keys()
+    for name, matrix in expected_matrices.items():
+        assert np.array_equal(matrices[name], matrix), name
+
+@pytest.fixture
+def run_find_clusters(tmp_path, monkeypatch):
+    # Clusters every leaf of a tree (with any of find_clusters.py's settings overridden) in a fresh directory, and returns what it
+    # found: {UUID: (cluster distance, samples)}, the unclustered samples, and every matrix it wrote, keyed by filename
+    runs = count()
+
+    def run(index, **settings):
+        run_dir = tmp_path / f"run{next(runs)}"
+        run_dir.mkdir()
+        monkeypatch.chdir(run_dir)
+        samples = sorted(index.leaves())
+        defaults = {'TYPE_PREFIX': 'a', 'OUTFILE_PREFIX': 'workdir', 'TREE_INDEX': index, 'INITIAL_SAMPS': samples, 'SAMPLES': fc.SampleRegistry(samples, index),
+            'MATRIX_ENGINE': 'rows', 'CONDENSED_MATRICES': False, 'MEMMAP_DIR': None, 'MATRIX_FORMAT': 'npy', 'SINGLE_LINKAGE': False, 'PREVIOUS_STATE': None,
+            'CLUSTER_DISTANCES': (20, 10, 5), 'WORKERS': 1, 'ARTIFACTS': None, 'CURRENT_UUID': np.int32(-1), 'LINKAGE': None, 'ALL_CLUSTERS': [],
+            'SAMPLES_IN_ANY_CLUSTER': set(), 'UNCLUSTERED_SAMPLES': set(), 'LATEST_CLUSTERS': [], 'LATEST_SAMPLES': [], 'SUBTREES_TO_EXTRACT': []}
+        for name, value in {**defaults, **settings}.items():
+            monkeypatch.setattr(fc, name, value)
+        fc.setup_clustering(fc.UINT32_MAX)
+        clusters = {str_UUID: (distance, tuple(fc.SAMPLES.names_of(sample_ids))) for str_UUID, distance, sample_ids in fc.LATEST_SAMPLES}
+        matrices = {path.name: np.load(path) for path in run_dir.glob("*_dmtrx.npy")}
+        return clusters, set(fc.UNCLUSTERED_SAMPLES), matrices
+
+    return run
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_lca_and_distances_match_walking_up_the_tree(seed):
+    index = tree_index(random_tree(seed, 60))
+    n = len(index.node_ids)
+    a, b = np.meshgrid(np.arange(n), np.arange(n))
+    lca = index.lca(a, b)
+    for i, j in zip(a.ravel().tolist(), b.ravel().tolist()):
+        ancestors_of_i = set()
+        node = i
+        while node >= 0:
+            ancestors_of_i.add(node)
+            node = index.parent[node]
+        node = j
+        while node not in ancestors_of_i:
+            node = index.parent[node]
+        assert lca[j, i] == node
+    assert np.array_equal(index.distances(a, b), index.depth[a] + index.depth[b] - 2 * index.depth[lca])
+
+@pytest.mark.parametrize("settings", [
+    {'MATRIX_ENGINE': 'blocks'},
+    {'MATRIX_ENGINE': 'blocks', 'ROW_BLOCK_BYTES': 64}, # every subtree block gets split into lots of chunks
+    {'MATRIX_ENGINE': 'neighbors'},
+    {'CONDENSED_MATRICES': True},
+    {'CONDENSED_MATRICES': True, 'MATRIX_ENGINE': 'blocks', 'ROW_BLOCK_BYTES': 64},
+    {'SINGLE_LINKAGE': True},
+    {'SINGLE_LINKAGE': True, 'MATRIX_ENGINE': 'neighbors'},
+    {'WORKERS': 3},
+    {'WORKERS': 3, 'SINGLE_LINKAGE': True, 'CONDENSED_MATRICES': True},
+], ids=lambda settings: ",".join(f"{name}={value}" for name, value in settings.items()))
+@pytest.mark.parametrize("seed", [1, 2])
+def test_engines_match_the_row_engine(run_find_clusters, seed, settings):
+    index = tree_index(random_tree(seed, 200))
+    expected = run_find_clusters(index)
+    assert any(distance == 5 for distance, _ in expected[0].values()) # or this wouldn't be much of a test
+    if settings.get('MATRIX_ENGINE') == 'neighbors':
+        expected[2].pop("aworkdir000000_dmtrx.npy") # there's no whole-tree matrix to write
+    assert_same_run(run_find_clusters(index, **settings), expected)
+
+def test_whole_tree_matrix_matches_tree(run_find_clusters):
+    index = tree_index(random_tree(4, 120))
+    _, _, matrices = run_find_clusters(index)
+    assert np.array_equal(matrices["aworkdir000000_dmtrx.npy"], pairwise(index, sorted(index.leaves())))
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_incremental_clustering_matches_clustering_from_scratch(run_find_clusters, tmp_path, caplog, seed):
+    rng = np.random.default_rng(seed)
+    previous = random_tree(seed, 200)
+    previous[2].append(["node_chain", 30, [["CHAIN_A", 12, []], ["CHAIN_B", 0, []], ["CHAIN_C", 12, []]]]) # A and C are only clustered through B
+    run_find_clusters(tree_index(previous), SINGLE_LINKAGE=True, MATRIX_ENGINE='neighbors')
+    fc.write_clustering_state(tmp_path / "clustering_state.npz")
+
+    # Some samples get removed, some move somewhere else on the tree, and some are new
+    current = previous
+    names = leaves(current)
+    for name in rng.choice(names, size=20, replace=False).tolist() + ["CHAIN_B"]:
+        remove_leaf(current, name)
+    moved = rng.choice(leaves(current), size=10, replace=False).tolist()
+    for name in moved:
+        remove_leaf(current, name)
+    internal = internal_nodes(current)
+    for k, name in enumerate(moved + [f"NEW{k:02d}" for k in range(20)]):
+        internal[int(rng.integers(len(internal)))][2].append([name, int(rng.choice(BRANCH_LENGTHS)), []])
+    index = tree_index(current)
+
+    expected = run_find_clusters(index, SINGLE_LINKAGE=True, MATRIX_ENGINE='neighbors')
+    caplog.set_level(logging.INFO)
+    assert_same_run(run_find_clusters(index, PREVIOUS_STATE=str(tmp_path / "clustering_state.npz"), SINGLE_LINKAGE=True, MATRIX_ENGINE='neighbors'), expected)
+    assert "Reused" in caplog.text # rather than quietly falling back to clustering from scratch
+
+def test_union_find_matches_single_linkage():
+    rng = np.random.default_rng(5)
+    n = 300
+    pairs_i, pairs_j = rng.integers(n, size=200), rng.integers(n, size=200)
+    pairs_d = rng.integers(30, size=200)
+    linkage = fc.SingleLinkage(np.arange(n, dtype=np.int32), pairs_i, pairs_j, pairs_d)
+    for distance in (5, 10, 20):
+        uf = fc.UnionFind(n)
+        for a, b in zip(pairs_i[pairs_d <= distance].tolist(), pairs_j[pairs_d <= distance].tolist()):
+            uf.union(a, b)
+        labels = linkage.labels_at(distance)
+        roots = np.array([uf.find(i) for i in range(n)])
+        assert np.array_equal(roots[:, None] == roots[None, :], labels[:, None] == labels[None, :])
+
+@pytest.mark.parametrize("k", [1, 3])
+def test_nearest_matches_every_distance(k):
+    index = tree_index(random_tree(6, 150))
+    names = sorted(index.leaves())
+    nodes = index.nodes_of(names)
+    distances = pairwise(index, names)
+    np.fill_diagonal(distances, np.iinfo(np.int64).max)
+    for f, (found, found_distances) in enumerate(index.nearest(nodes, nodes, k)):
+        kth = np.sort(distances[f])[k - 1]
+        expected = sorted((distances[f, j], names[j]) for j in np.flatnonzero(distances[f] <= kth).tolist())
+        assert list(zip(found_distances.tolist(), index.node_ids[found].tolist())) == expected
+
+def test_newick_keeps_every_distance():
+    index = tree_index(random_tree(7, 150))
+    names = sorted(index.leaves())
+    assert np.array_equal(pairwise(parse_newick(index.newick(index.nodes_of(names))), names), pairwise(index, names))
+    subset = names[::7]
+    subtree = parse_newick(index.newick(index.nodes_of(subset)))
+    assert sorted(subtree.leaves()) == subset
+    assert np.array_equal(pairwise(subtree, subset), pairwise(index, subset))
+
+def test_cached_tree_index_matches(tmp_path):
+    index = tree_index(random_tree(8, 100))
+    pb = tmp_path / "tree.pb"
+    pb.write_bytes(b"not actually a tree, but the cache only goes by its hash")
+    index.write_cache(tmp_path / fc.file_hash(pb))
+    cached, tree = fc.TreeIndex.for_pb(pb, cache_dir=tmp_path)
+    assert tree is None
+    nodes = np.arange(len(index.node_ids))
+    assert np.array_equal(cached.distances(nodes[:, None], nodes[None, :]), index.distances(nodes[:, None], nodes[None, :]))